@@ -98,6 +98,10 @@ class Bands2RGB(QgsProcessingAlgorithm):
     G = 'G'
     B = 'B'
     RGB = 'RGB'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -127,6 +131,41 @@ class Bands2RGB(QgsProcessingAlgorithm):
             )
         )
         
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -144,6 +183,36 @@ class Bands2RGB(QgsProcessingAlgorithm):
             )
         )
         
+    # OpcoesGTiff e CriarPiramides: cópia de referência, repetida de forma idêntica (cada script é instalado separadamente) em
+    # createHolesInRaster.py, defineNullCell.py, extractRasterBand.py, fillRasterwithPatches.py, mosaicRaster.py,
+    # removeAlphaBand.py, rescaleTo8bits.py e supervisedClassification.py. Corrigir aqui e replicar as mesmas alterações nas cópias
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
 
         Band_R = self.parameterAsRasterLayer(
@@ -182,6 +251,32 @@ class Bands2RGB(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
         # Abrir banda R 
         image = gdal.Open(Band_R.dataProvider().dataSourceUri())
         bandR = image.GetRasterBand(1).ReadAsArray()
@@ -204,12 +299,14 @@ class Bands2RGB(QgsProcessingAlgorithm):
         GDT = gdal_array.NumericTypeCodeToGDALTypeCode(bandB.dtype)
 
         # Criar imagem RGB
-        RGB = gdal.GetDriverByName('GTiff').Create(RGB_Output, n_col, n_lin, 3, GDT)
+        RGB = gdal.GetDriverByName('GTiff').Create(RGB_Output, n_col, n_lin, 3, GDT, options = self.OpcoesGTiff(GDT, 3, compressao, tiled, ladrilho))
         RGB.SetGeoTransform(geotransform)    # specify coords
         RGB.SetProjection(CRS.ExportToWkt()) # export coords to file
         RGB.GetRasterBand(1).WriteArray(bandR)   # write R band to the raster
         RGB.GetRasterBand(2).WriteArray(bandG)   # write G band to the raster
         RGB.GetRasterBand(3).WriteArray(bandB)   # write B band to the raster
+        if piramides:
+            self.CriarPiramides(RGB)
         RGB.FlushCache()   # Escrever no disco
         RGB = None   # Salvar e fechar
         CRS = None
@@ -45,9 +45,8 @@ from qgis.core import (QgsProcessing,
                        QgsCoordinateTransform,
                        QgsCoordinateReferenceSystem)
 import gdal
-from osgeo import osr, gdal_array
+from osgeo import ogr
 import numpy as np
-from matplotlib import path
 
 class CreateHolesInRaster(QgsProcessingAlgorithm):
 
@@ -99,6 +98,12 @@ class CreateHolesInRaster(QgsProcessingAlgorithm):
     RasterIN ='RasterIN'
     HOLES = 'HOLES'
     RasterOUT = 'RasterOUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
+    MODE = 'MODE'
+    INPLACE = 'INPLACE'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -119,12 +124,69 @@ class CreateHolesInRaster(QgsProcessingAlgorithm):
             )
         )
         
+        modos = [self.tr('Null values (or alpha band)', 'Valores nulos (ou banda alfa)'),
+                 self.tr('Internal mask band', 'Banda de máscara interna'),
+                 self.tr('External 1-bit mask file (.msk)', 'Arquivo de máscara externo de 1 bit (.msk)')]
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MODE,
+                self.tr('Holes written as', 'Buracos gravados como'),
+				options = modos,
+                defaultValue= 0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INPLACE,
+                self.tr('Update input raster in place', 'Atualizar o raster de entrada (sem criar nova imagem)'),
+                defaultValue= False
+            )
+        )
+        
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 self.RasterOUT,
                 self.tr('Bumpy Raster', 'Raster Esburacado'),
-                fileFilter = '.tif'
+                fileFilter = '.tif',
+                optional = True
             )
         )
         
@@ -136,6 +198,80 @@ class CreateHolesInRaster(QgsProcessingAlgorithm):
             )
         )
     
+    # Camada OGR em memória com os polígonos dos buracos no SRC da imagem
+    def CamadaBuracos(self, source, prj):
+        fonte = ogr.GetDriverByName('Memory').CreateDataSource('')
+        camada = fonte.CreateLayer('buracos', geom_type = ogr.wkbMultiPolygon)
+        crsDest = QgsCoordinateReferenceSystem(prj)
+        coordTransf = QgsCoordinateTransform(source.sourceCrs(), crsDest, QgsProject.instance()) if source.sourceCrs() != crsDest else None
+        for feature in source.getFeatures():
+            geom = feature.geometry()
+            if geom.isEmpty():
+                continue
+            if coordTransf:
+                geom.transform(coordTransf)
+            feat = ogr.Feature(camada.GetLayerDefn())
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+            camada.CreateFeature(feat)
+        return fonte
+    
+    # Máscara dos pixels de uma grade cujos centros estão dentro dos polígonos dos buracos
+    # Rasterização em memória: considera todas as partes e os buracos (anéis internos) dos polígonos
+    def MascaraBuracos(self, fonte, origem, resol_X, resol_Y, n_lin, n_col):
+        grade = gdal.GetDriverByName('MEM').Create('', n_col, n_lin, 1, gdal.GDT_Byte)
+        grade.SetGeoTransform([origem[0], resol_X, 0, origem[1], 0, -resol_Y])
+        camada = fonte.GetLayer(0)
+        camada.SetSpatialFilterRect(origem[0], origem[1] - n_lin*resol_Y, origem[0] + n_col*resol_X, origem[1])
+        gdal.RasterizeLayer(grade, [1], camada, burn_values = [1])
+        camada.SetSpatialFilter(None)
+        mascara = grade.GetRasterBand(1).ReadAsArray().astype(bool)
+        grade = None
+        return mascara
+    
+    # Blocos da imagem que intersectam os polígonos dos buracos (pela extensão de cada polígono)
+    def BlocosBuracos(self, fonte, origem, resol_X, resol_Y, rows, cols, lado):
+        blocos = set()
+        for feat in fonte.GetLayer(0):
+            x_min, x_max, y_min, y_max = feat.GetGeometryRef().GetEnvelope()
+            lin_ini = max(int((origem[1] - y_max)/resol_Y), 0)//lado
+            lin_fim = min(int((origem[1] - y_min)/resol_Y), rows-1)//lado
+            col_ini = max(int((x_min - origem[0])/resol_X), 0)//lado
+            col_fim = min(int((x_max - origem[0])/resol_X), cols-1)//lado
+            for i in range(lin_ini, lin_fim+1):
+                for j in range(col_ini, col_fim+1):
+                    blocos.add((i*lado, j*lado))
+        fonte.GetLayer(0).ResetReading()
+        return sorted(blocos)
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
         
         RasterIN = self.parameterAsRasterLayer(
@@ -166,11 +302,65 @@ class CreateHolesInRaster(QgsProcessingAlgorithm):
             self.OPEN,
             context
         )
+        
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
          
-        # Abrir Raster layer como array
-        image = gdal.Open(RasterIN)
-        prj=image.GetProjection()
-        CRS=osr.SpatialReference(wkt=prj)
+        modo = self.parameterAsEnum(
+            parameters,
+            self.MODE,
+            context
+        )
+        
+        atualizar = self.parameterAsBool(
+            parameters,
+            self.INPLACE,
+            context
+        )
+        
+        # Máscara interna no GeoTIFF ou arquivo externo .msk
+        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'NO' if modo == 2 else 'YES')
+        
+        # Imagem de saída: o próprio raster de entrada (atualização) ou uma cópia dele
+        if atualizar:
+            feedback.pushInfo(self.tr('Opening input raster for update...', 'Abrindo raster de entrada para atualização...'))
+            image = gdal.Open(RasterIN, gdal.GA_Update)
+            if image is None:
+                raise QgsProcessingException(self.tr('The input raster cannot be updated in place!', 'O raster de entrada não pode ser atualizado!'))
+            RGB_Output = RasterIN
+        else:
+            if not RGB_Output:
+                raise QgsProcessingException(self.tr('Choose the output file or the in-place update mode!', 'Escolha o arquivo de saída ou o modo de atualização do raster de entrada!'))
+            entrada = gdal.Open(RasterIN)
+            GDT = entrada.GetRasterBand(1).DataType
+            feedback.pushInfo(self.tr('Copying input raster...', 'Copiando raster de entrada...'))
+            gdal.GetDriverByName('GTiff').CreateCopy(RGB_Output, entrada, options = self.OpcoesGTiff(GDT, entrada.RasterCount, compressao, tiled, ladrilho))
+            entrada = None
+            image = gdal.Open(RGB_Output, gdal.GA_Update)
+        prj = image.GetProjection()
         geotransform = image.GetGeoTransform()
         n_bands = image.RasterCount # Número de bandas
         cols = image.RasterXSize # Number of columns
@@ -180,90 +370,70 @@ class CreateHolesInRaster(QgsProcessingAlgorithm):
         origem = (ulx, uly)
         resol_X = abs(xres)
         resol_Y = abs(yres)
-        feedback.pushInfo(self.tr('Opening Band R...', 'Abrindo Banda R...'))
-        band1 = image.GetRasterBand(1).ReadAsArray()
-        feedback.pushInfo(self.tr('Opening Band G...', 'Abrindo Banda G...'))
-        band2 = image.GetRasterBand(2).ReadAsArray()
-        feedback.pushInfo(self.tr('Opening Band B...', 'Abrindo Banda B...'))
-        band3 = image.GetRasterBand(3).ReadAsArray()
-        # Transparência
-        if n_bands == 4:
-            feedback.pushInfo(self.tr('Opening Band Alpha...', 'Abrindo Banda Alfa...'))
-            band4 = image.GetRasterBand(4).ReadAsArray()
-        Pixel_Nulo = image.GetRasterBand(1).GetNoDataValue()
+        bandas = [image.GetRasterBand(k+1) for k in range(n_bands)]
+        # Banda alfa (transparência): interpretação de cor alfa ou a 4ª banda de uma imagem RGBA
+        alfa = [k for k in range(n_bands) if bandas[k].GetColorInterpretation() == gdal.GCI_AlphaBand]
+        alfa = alfa[0] if alfa else (3 if n_bands == 4 else None)
+        Pixel_Nulo = bandas[0].GetNoDataValue()
         if Pixel_Nulo == None:
             Pixel_Nulo = 0
-        image=None # Fechar imagem
-
-        # Remendos
-        total = 100.0 /layer.featureCount() if layer.featureCount() else 0
-
-        for cont, feat in enumerate(layer.getFeatures()):
-            geom = feat.geometry()
-            coords = geom.asPolygon()[0]
-            caminho = []
-            for ponto in coords:
-                linha = (origem[1]-ponto.y())/resol_Y
-                coluna = (ponto.x() - origem[0])/resol_X
-                caminho += [(linha, coluna)]
-            p = path.Path(caminho)
-            box = geom.boundingBox()
-            uly = box.yMaximum()
-            lry = box.yMinimum()
-            ulx = box.xMinimum()
-            lrx = box.xMaximum()
-            
-            # Limites de Varredura
-            row_ini = int(round((origem[1]-uly)/resol_Y - 0.5))-1
-            row_fim = int(round((origem[1]-lry)/resol_Y - 0.5))+1
-            col_ini = int(round((ulx - origem[0])/resol_X - 0.5))-1
-            col_fim = int(round((lrx - origem[0])/resol_X - 0.5))+1
-            
-            # Varrer Raster
-            if n_bands == 4:
-                for lin in range(row_ini, row_fim):
-                    for col in range(col_ini, col_fim):
-                        pixel = (lin+0.5, col+0.5)
-                        if p.contains_points([pixel]):
-                            band4[lin][col] = 0
-            else:
-                for lin in range(row_ini, row_fim):
-                    for col in range(col_ini, col_fim):
-                        pixel = (lin+0.5, col+0.5)
-                        if p.contains_points([pixel]):
-                            band1[lin][col] = Pixel_Nulo
-                            band2[lin][col] = Pixel_Nulo
-                            band3[lin][col] = Pixel_Nulo
-            feedback.setProgress(int(cont * total))
-
-        # Criar imagem RGB
-        feedback.pushInfo(self.tr('Saving Raster...', 'Salvando Raster...'))
-        GDT = gdal_array.NumericTypeCodeToGDALTypeCode(band1.dtype)
-        if n_bands == 4:
-            RGB = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, 4, GDT)
-        else:
-            RGB = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, 3, GDT)
-        RGB.SetGeoTransform(geotransform)    # specify coords
-        RGB.SetProjection(CRS.ExportToWkt()) # export coords to file
-        feedback.pushInfo(self.tr('Writing Band R...', 'Escrevendo Banda R...'))
-        bandaR = RGB.GetRasterBand(1)
-        bandaR.WriteArray(band1)
-        feedback.pushInfo(self.tr('Writing Band G...', 'Escrevendo Banda G...'))
-        bandaG = RGB.GetRasterBand(2)
-        bandaG.WriteArray(band2)
-        feedback.pushInfo(self.tr('Writing Band B...', 'Escrevendo Banda B...'))
-        bandaB = RGB.GetRasterBand(3)
-        bandaB.WriteArray(band3)
-        if n_bands == 4:
-            feedback.pushInfo(self.tr('Writing Alpha Band...', 'Escrevendo Banda Alfa...'))
-            bandaAlpha = RGB.GetRasterBand(4)
-            bandaAlpha.WriteArray(band4)
-        else:
-            bandaR.SetNoDataValue(Pixel_Nulo)
-            bandaG.SetNoDataValue(Pixel_Nulo)
-            bandaB.SetNoDataValue(Pixel_Nulo)
-        RGB.FlushCache()   # Escrever no disco
-        RGB = None   # Salvar e fechar
+        
+        # Banda de máscara (interna ou externa). Quando ainda não existir, é criada como cópia da máscara
+        # implícita da imagem (valor nulo, banda alfa ou todos válidos), já que a máscara explícita tem prioridade sobre elas
+        if modo != 0:
+            if bandas[0].GetMaskFlags() != gdal.GMF_PER_DATASET:
+                feedback.pushInfo(self.tr('Creating mask band...', 'Criando banda de máscara...'))
+                # Conexão somente leitura para a máscara implícita, obtida antes da criação da máscara explícita
+                leitura = gdal.Open(RGB_Output)
+                mascara_antiga = leitura.GetRasterBand(1).GetMaskBand()
+                image.CreateMaskBand(gdal.GMF_PER_DATASET)
+                mascara = bandas[0].GetMaskBand()
+                passo = max(2**24 // cols, 1)
+                for lin_ini in range(0, rows, passo):
+                    n_lin = min(passo, rows - lin_ini)
+                    mascara.WriteArray(mascara_antiga.ReadAsArray(0, lin_ini, cols, n_lin), 0, lin_ini)
+                mascara_antiga = None
+                leitura = None
+            mascara = bandas[0].GetMaskBand()
+        elif alfa is None:
+            for bd in bandas:
+                bd.SetNoDataValue(Pixel_Nulo)
+        
+        # Buracos: polígonos rasterizados somente nos blocos que eles intersectam
+        feedback.pushInfo(self.tr('Rasterizing holes...', 'Rasterizando buracos...'))
+        fonte = self.CamadaBuracos(layer, prj)
+        lado = 1024
+        blocos = self.BlocosBuracos(fonte, origem, resol_X, resol_Y, rows, cols, lado)
+        total = 100.0 / len(blocos) if blocos else 0
+        for cont, (lin_ini, col_ini) in enumerate(blocos):
+            if feedback.isCanceled():
+                break
+            n_lin = min(lado, rows - lin_ini)
+            n_col = min(lado, cols - col_ini)
+            buracos = self.MascaraBuracos(fonte, (origem[0] + col_ini*resol_X, origem[1] - lin_ini*resol_Y), resol_X, resol_Y, n_lin, n_col)
+            if buracos.any():
+                if modo != 0:
+                    janela = mascara.ReadAsArray(col_ini, lin_ini, n_col, n_lin)
+                    janela[buracos] = 0
+                    mascara.WriteArray(janela, col_ini, lin_ini)
+                elif alfa is not None:
+                    janela = bandas[alfa].ReadAsArray(col_ini, lin_ini, n_col, n_lin)
+                    janela[buracos] = 0
+                    bandas[alfa].WriteArray(janela, col_ini, lin_ini)
+                else:
+                    for bd in bandas:
+                        janela = bd.ReadAsArray(col_ini, lin_ini, n_col, n_lin)
+                        janela[buracos] = Pixel_Nulo
+                        bd.WriteArray(janela, col_ini, lin_ini)
+            feedback.setProgress(int((cont+1) * total))
+        fonte = None
+        
+        if piramides:
+            feedback.pushInfo(self.tr('Building overviews...', 'Criando pirâmides...'))
+            self.CriarPiramides(image)
+        image.FlushCache()   # Escrever no disco
+        image = None   # Salvar e fechar
+        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
         
         feedback.pushInfo(self.tr('Operation completed successfully!', 'Operação finalizada com sucesso!'))
         feedback.pushInfo('Leandro França - Eng Cart')
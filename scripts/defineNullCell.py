@@ -99,7 +99,13 @@ class DefineNullCell(QgsProcessingAlgorithm):
     MIN = 'MIN'
     MAX = 'MAX'
     NULLVALUE = 'NULLVALUE'
+    INTERVALS = 'INTERVALS'
+    MASKBAND = 'MASKBAND'
     RasterOUT = 'RasterOUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -139,6 +145,24 @@ class DefineNullCell(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.INTERVALS,
+                self.tr('Valid intervals (min,max separated by ";", one group per band separated by "|"; empty to use minimum and maximum values)',
+                        'Intervalos válidos (mín,máx separados por ";", um grupo por banda separado por "|"; vazio para usar os valores mínimo e máximo)'),
+                defaultValue = '',
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.MASKBAND,
+                self.tr('Write a mask band instead of changing values', 'Gravar uma banda de máscara em vez de alterar os valores'),
+                defaultValue= False
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterBoolean(
                 self.OPEN,
@@ -147,6 +171,41 @@ class DefineNullCell(QgsProcessingAlgorithm):
             )
         )
         
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -156,6 +215,57 @@ class DefineNullCell(QgsProcessingAlgorithm):
             )
         )
     
+    # Intervalos válidos de cada banda a partir do texto (ex.: '1,100;200,65535' ou '1,100 | 5,50;60,90 | 0,255')
+    # Um único grupo vale para todas as bandas; sem texto, vale o intervalo [MIN, MAX]
+    def Intervalos(self, texto, n_bands, MIN, MAX):
+        if not texto.strip():
+            return [[(MIN, MAX)]]*n_bands
+        try:
+            grupos = [[tuple([float(v) for v in par.split(',')]) for par in grupo.split(';') if par.strip()] for grupo in texto.split('|')]
+        except ValueError:
+            grupos = []
+        if len(grupos) == 1:
+            grupos = grupos*n_bands
+        if len(grupos) != n_bands or any([len(grupo) == 0 or any([len(par) != 2 or par[1] < par[0] for par in grupo]) for grupo in grupos]):
+            raise QgsProcessingException(self.tr('Problem in the valid intervals!', 'Problema nos intervalos válidos!'))
+        return grupos
+    
+    # Máscara dos pixels dentro de algum dos intervalos válidos
+    def Validos(self, bloco, intervalos):
+        validos = np.zeros(bloco.shape, dtype=bool)
+        for Min, Max in intervalos:
+            validos |= (bloco >= Min) & (bloco <= Max)
+        return validos
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
         
         RasterIN = self.parameterAsRasterLayer(
@@ -179,6 +289,32 @@ class DefineNullCell(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
         MIN = self.parameterAsDouble(
             parameters,
             self.MIN,
@@ -197,7 +333,19 @@ class DefineNullCell(QgsProcessingAlgorithm):
             context
         )
         
-        if MAX < MIN or (Pixel_Nulo>MIN and Pixel_Nulo<MAX):
+        texto = self.parameterAsString(
+            parameters,
+            self.INTERVALS,
+            context
+        )
+        
+        mascara = self.parameterAsBool(
+            parameters,
+            self.MASKBAND,
+            context
+        )
+        
+        if not texto.strip() and (MAX < MIN or (Pixel_Nulo>MIN and Pixel_Nulo<MAX)):
             raise QgsProcessingException(self.tr('Problem in input parameters interval!', 'Problema no intervalo dos parâmetros de entrada!'))
             
         else:
@@ -208,23 +356,58 @@ class DefineNullCell(QgsProcessingAlgorithm):
             n_bands = image.RasterCount
             cols = image.RasterXSize # Number of columns
             rows = image.RasterYSize # Number of rows
+            # Valor nulo deve ser representável no tipo de dado inteiro da imagem
+            tipo = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(GDT))
+            if not mascara and np.issubdtype(tipo, np.integer):
+                limites = np.iinfo(tipo)
+                if not np.isfinite(Pixel_Nulo) or Pixel_Nulo != int(Pixel_Nulo) or not limites.min <= Pixel_Nulo <= limites.max:
+                    raise QgsProcessingException(self.tr('Null pixel value {} is not valid for the raster data type {} ({} to {})!'.format(Pixel_Nulo, gdal.GetDataTypeName(GDT), limites.min, limites.max),
+                                                         'Valor do pixel nulo {} não é válido para o tipo de dado do raster {} ({} a {})!'.format(Pixel_Nulo, gdal.GetDataTypeName(GDT), limites.min, limites.max)))
             # Create CRS object
             CRS=osr.SpatialReference(wkt=prj)
             # Criate driver
-            Driver = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, n_bands, GDT)
+            Driver = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, n_bands, GDT, options = self.OpcoesGTiff(GDT, n_bands, compressao, tiled, ladrilho))
             Driver.SetGeoTransform(geotransform)    # specify coords
             Driver.SetProjection(CRS.ExportToWkt()) # export coords to file
             
-            for k in range(n_bands):
-                band = image.GetRasterBand(k+1).ReadAsArray()
-                # Defining null pixels
-                band = ((band>=MIN)*(band<=MAX))*band + ((band<MIN)*(band>MAX))*Pixel_Nulo
-                outband = Driver.GetRasterBand(k+1)
-                feedback.pushInfo(self.tr('Writing Band {}...'.format(k+1), 'Escrevendo Banda {}...'.format(k+1)))
-                outband.WriteArray(band) # write band to the raster
-                outband.SetNoDataValue(Pixel_Nulo)
+            intervalos = self.Intervalos(texto, n_bands, MIN, MAX)
+            if not mascara and any([Min < Pixel_Nulo < Max for grupo in intervalos for Min, Max in grupo]):
+                raise QgsProcessingException(self.tr('Problem in input parameters interval!', 'Problema no intervalo dos parâmetros de entrada!'))
+            if mascara: # máscara interna no GeoTIFF
+                gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+                Driver.CreateMaskBand(gdal.GMF_PER_DATASET)
+                gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
+                outmask = Driver.GetRasterBand(1).GetMaskBand()
+            
+            # Faixas de linhas com até 2**22 pixels
+            passo = max(2**22 // cols, 1)
+            faixas = list(range(0, rows, passo))
+            total = 100.0/len(faixas) if faixas else 0
+            for cont, lin in enumerate(faixas):
+                if feedback.isCanceled():
+                    break
+                n_lin = min(passo, rows - lin)
+                validos_todas = np.ones((n_lin, cols), dtype=bool)
+                for k in range(n_bands):
+                    band = image.GetRasterBand(k+1).ReadAsArray(0, lin, cols, n_lin)
+                    # Defining null pixels
+                    validos = self.Validos(band, intervalos[k])
+                    if mascara:
+                        validos_todas &= validos
+                    else:
+                        np.putmask(band, ~validos, Pixel_Nulo)
+                    Driver.GetRasterBand(k+1).WriteArray(band, 0, lin) # write band to the raster
+                # Máscara do conjunto de dados: pixel nulo se estiver fora dos intervalos em alguma banda
+                if mascara:
+                    outmask.WriteArray(validos_todas.astype(np.uint8)*255, 0, lin)
+                feedback.setProgress(int((cont+1) * total))
+            if not mascara:
+                for k in range(n_bands):
+                    Driver.GetRasterBand(k+1).SetNoDataValue(Pixel_Nulo)
             
             image=None # Close dataset
+            if piramides:
+                self.CriarPiramides(Driver)
             Driver.FlushCache()                     # write to disk
             Driver = None                           # save, close
             
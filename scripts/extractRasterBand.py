@@ -101,6 +101,10 @@ class ExtractRasterBand(QgsProcessingAlgorithm):
     INPUT = 'INPUT'
     BAND = 'BAND'
     OUTPUT = 'OUTPUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -121,6 +125,41 @@ class ExtractRasterBand(QgsProcessingAlgorithm):
             )
         )
         
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -138,6 +177,35 @@ class ExtractRasterBand(QgsProcessingAlgorithm):
             )
         )
         
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
 
         entrada = self.parameterAsRasterLayer(
@@ -168,6 +236,32 @@ class ExtractRasterBand(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
         # Abrir banda
         feedback.pushInfo(self.tr('Reading the selected band...', 'Lendo a banda selecionada...'))
         image = gdal.Open(entrada.dataProvider().dataSourceUri())
@@ -188,10 +282,12 @@ class ExtractRasterBand(QgsProcessingAlgorithm):
 
         # Criar imagem com uma única banda
         feedback.pushInfo(self.tr('Writing the selected band...', 'Escrevendo a banda selecionada...'))
-        nova_imagem = gdal.GetDriverByName('GTiff').Create(saida, cols, rows, 1, GDT)
+        nova_imagem = gdal.GetDriverByName('GTiff').Create(saida, cols, rows, 1, GDT, options = self.OpcoesGTiff(GDT, 1, compressao, tiled, ladrilho))
         nova_imagem.SetGeoTransform(geotransform)
         nova_imagem.SetProjection(CRS.ExportToWkt())
         nova_imagem.GetRasterBand(1).WriteArray(banda)
+        if piramides:
+            self.CriarPiramides(nova_imagem)
         nova_imagem.FlushCache() # Escrever no disco
         nova_imagem = None # Salvar e fechar
         CRS = None
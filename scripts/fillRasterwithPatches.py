@@ -31,6 +31,7 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterBoolean,
                        QgsProcessingParameterCrs,
                        QgsProcessingParameterEnum,
+                       QgsProcessingParameterNumber,
                        QgsFeatureRequest,
                        QgsExpression,
                        QgsProcessingParameterFeatureSource,
@@ -42,12 +43,16 @@ from qgis.core import (QgsProcessing,
                        QgsApplication,
                        QgsProject,
                        QgsRasterLayer,
+                       QgsRectangle,
+                       QgsSpatialIndex,
                        QgsCoordinateTransform,
                        QgsCoordinateReferenceSystem)
 import gdal
-from osgeo import osr, gdal_array
+from osgeo import ogr
 from math import floor, ceil
+from datetime import datetime
 import numpy as np
+import os
 
 class FillRasterwithPatches(QgsProcessingAlgorithm):
 
@@ -98,7 +103,17 @@ class FillRasterwithPatches(QgsProcessingAlgorithm):
     
     RasterIN ='RasterIN'
     PATCHES = 'PATCHES'
+    THRESHOLD = 'THRESHOLD'
+    MASK = 'MASK'
+    RESAMPLING = 'RESAMPLING'
+    FEATHER = 'FEATHER'
+    PRIORITY = 'PRIORITY'
     RasterOUT = 'RasterOUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
+    INPLACE = 'INPLACE'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -119,12 +134,110 @@ class FillRasterwithPatches(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.THRESHOLD,
+                self.tr('Thresholds per band (comma separated, empty to skip a band)', 'Limiares por banda (separados por vírgula, vazio para ignorar a banda)'),
+                defaultValue = '240',
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.MASK,
+                self.tr('Mask polygons (areas to patch)', 'Polígonos de máscara (áreas a remendar)'),
+                [QgsProcessing.TypeVectorPolygon],
+                optional = True
+            )
+        )
+        
+        interp = [self.tr('Nearest neighbor', 'Vizinho mais próximo'),
+                 self.tr('Bilinear'),
+                 self.tr('Bicubic', 'Bicúbica')]
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.RESAMPLING,
+                self.tr('Interpolation', 'Interpolação'),
+				options = interp,
+                defaultValue= 0
+            )
+        )
+        
+        prioridade = [self.tr('First valid (list order)', 'Primeiro válido (ordem da lista)'),
+                      self.tr('Best resolution', 'Melhor resolução'),
+                      self.tr('Most recent', 'Mais recente')]
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.PRIORITY,
+                self.tr('Patch priority', 'Prioridade dos remendos'),
+				options = prioridade,
+                defaultValue= 0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.FEATHER,
+                self.tr('Blend width at patch borders (pixels)', 'Largura da suavização nas bordas do remendo (pixels)'),
+                type =0, #Double = 1 and Integer = 0
+                defaultValue = 0,
+                minValue = 0
+            )
+        )
+        
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INPLACE,
+                self.tr('Update input raster in place', 'Atualizar o raster de entrada (sem criar nova imagem)'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 self.RasterOUT,
                 self.tr('Patched Image', 'Imagem Remendada'),
-                fileFilter = '.tif'
+                fileFilter = '.tif',
+                optional = True
             )
         )
         
@@ -136,67 +249,181 @@ class FillRasterwithPatches(QgsProcessingAlgorithm):
             )
         )
     
-    # Função de Interpolação
+    # Função de Interpolação (vetorizada)
+    # X e Y são arrays com as coordenadas dos centros dos pixels de destino.
+    # BAND pode ser uma banda (linhas x colunas) ou uma pilha de bandas (bandas x linhas x colunas).
+    # Retorna os valores interpolados e a máscara dos valores válidos (não nulos).
     def Interpolar(self, X, Y, BAND, origem, resol_X, resol_Y, metodo, nulo):
+        nlin, ncol = BAND.shape[-2:]
+        I = (origem[1]-Y)/resol_Y - 0.5
+        J = (X - origem[0])/resol_X - 0.5
         if metodo == 'nearest':
-            linha = int(round((origem[1]-Y)/resol_Y - 0.5))
-            coluna = int(round((X - origem[0])/resol_X - 0.5))
-            if BAND[linha][coluna] != nulo:
-                return float(BAND[linha][coluna])
-            else:
-                return nulo
+            linha = np.clip(np.round(I).astype(int), 0, nlin-1)
+            coluna = np.clip(np.round(J).astype(int), 0, ncol-1)
+            Z = BAND[..., linha, coluna]
+            validos = Z != nulo
+            return Z.astype(float), validos
         elif metodo == 'bilinear':
-            nlin = len(BAND)
-            ncol = len(BAND[0])
-            I = (origem[1]-Y)/resol_Y - 0.5
-            J = (X - origem[0])/resol_X - 0.5
-            di = I - floor(I)
-            dj = J - floor(J)
-            if I<0:
-                I=0
-            if I>nlin-1:
-                I=nlin-1
-            if J<0:
-                J=0
-            if J>ncol-1:
-                J=ncol-1
-            if (BAND[int(floor(I)):int(ceil(I))+1, int(floor(J)):int(ceil(J))+1] == nulo).sum() == 0:
-                Z = (1-di)*(1-dj)*BAND[int(floor(I))][int(floor(J))] + (1-dj)*di*BAND[int(ceil(I))][int(floor(J))] + (1-di)*dj*BAND[int(floor(I))][int(ceil(J))] + di*dj*BAND[int(ceil(I))][int(ceil(J))]
-                return float(Z)
-            else:
-                return nulo
+            di = I - np.floor(I)
+            dj = J - np.floor(J)
+            I = np.clip(I, 0, nlin-1)
+            J = np.clip(J, 0, ncol-1)
+            I0, I1 = np.floor(I).astype(int), np.ceil(I).astype(int)
+            J0, J1 = np.floor(J).astype(int), np.ceil(J).astype(int)
+            Z00, Z10 = BAND[..., I0, J0], BAND[..., I1, J0]
+            Z01, Z11 = BAND[..., I0, J1], BAND[..., I1, J1]
+            validos = (Z00 != nulo) & (Z10 != nulo) & (Z01 != nulo) & (Z11 != nulo)
+            Z = (1-di)*(1-dj)*Z00 + (1-dj)*di*Z10 + (1-di)*dj*Z01 + di*dj*Z11
+            return Z, validos
         elif metodo == 'bicubic':
-            nlin = len(BAND)
-            ncol = len(BAND[0])
-            I = (origem[1]-Y)/resol_Y - 0.5
-            J = (X - origem[0])/resol_X - 0.5
-            di = I - floor(I)
-            dj = J - floor(J)
-            I=int(floor(I))
-            J=int(floor(J))
-            if I<2:
-                I=2
-            if I>nlin-3:
-                I=nlin-3
-            if J<2:
-                J=2
-            if J>ncol-3:
-                J=ncol-3
-            if (BAND[I-1:I+3, J-1:J+3] == nulo).sum() == 0:
-                MatrInv = (mat([[-1, 1, -1, 1], [0, 0, 0, 1], [1, 1, 1, 1], [8, 4, 2, 1]])).I # < Jogar para fora da funcao
-                MAT  = mat([[BAND[I-1, J-1],   BAND[I-1, J],   BAND[I-1, J+1],  BAND[I-2, J+2]],
-                                     [BAND[I, J-1],      BAND[I, J],      BAND[I, J+1],      BAND[I, J+2]],
-                                     [BAND[I+1, J-1],  BAND[I+1, J], BAND[I+1, J+1], BAND[I+1, J+2]],
-                                     [BAND[I+2, J-1],  BAND[I+2, J], BAND[I+2, J+1], BAND[I+2, J+2]]])
-                coef = MatrInv*MAT.transpose()
-                # Horizontal
-                pi = coef[0,:]*pow(dj,3)+coef[1,:]*pow(dj,2)+coef[2,:]*dj+coef[3,:]
-                # Vertical
-                coef2 = MatrInv*pi.transpose()
-                pj = coef2[0]*pow(di,3)+coef2[1]*pow(di,2)+coef2[2]*di+coef2[3]
-                return float(pj)
-            else:
-                return nulo
+            di = I - np.floor(I)
+            dj = J - np.floor(J)
+            I = np.clip(np.floor(I).astype(int), 2, nlin-3)
+            J = np.clip(np.floor(J).astype(int), 2, ncol-3)
+            MatrInv = np.array([[-1/6, 0.5, -0.5, 1/6], [ 0.5, -1., 0.5, 0.], [-1/3, -0.5,  1., -1/6], [ 0., 1., 0., 0.]]) # resultado da inversa: (np.mat([[-1, 1, -1, 1], [0, 0, 0, 1], [1, 1, 1, 1], [8, 4, 2, 1]])).I #
+            # Pesos dos 4 vizinhos na vertical e na horizontal
+            Wi = np.stack((di**3, di**2, di, np.ones(di.shape)), axis=-1) @ MatrInv
+            Wj = np.stack((dj**3, dj**2, dj, np.ones(dj.shape)), axis=-1) @ MatrInv
+            desloc = np.arange(-1, 3)
+            MAT = BAND[..., (I[:,np.newaxis] + desloc)[:,:,np.newaxis], (J[:,np.newaxis] + desloc)[:,np.newaxis,:]]
+            validos = (MAT != nulo).all(axis=(-2,-1))
+            Z = np.einsum('ni,...nij,nj->...n', Wi, MAT.astype(float), Wj)
+            return Z, validos
+    
+    # Abrir cada remendo uma única vez, guardando a georreferência e a extensão
+    def AbrirRemendos(self, PatchesLayers):
+        remendos = []
+        for Remendo in PatchesLayers:
+            Rem = gdal.Open(Remendo.dataProvider().dataSourceUri())
+            if Rem is None:
+                raise QgsProcessingException(self.tr('Could not open the patch layer {}!', 'Não foi possível abrir a camada de remendo {}!').format(Remendo.name()))
+            ulx, xres, xskew, uly, yskew, yres  = Rem.GetGeoTransform()
+            nulo = Rem.GetRasterBand(1).GetNoDataValue()
+            remendos += [{'nome': Remendo.name(), 'image': Rem, 'origem': (ulx, uly), 'xres': abs(xres), 'yres': abs(yres),
+                          'cols': Rem.RasterXSize, 'rows': Rem.RasterYSize,
+                          'lrx': ulx + Rem.RasterXSize*xres, 'lry': uly + Rem.RasterYSize*yres,
+                          'nulo': 0 if nulo is None else nulo}]
+        return remendos
+    
+    # Data do remendo: metadado TIFFTAG_DATETIME ou, na falta dele, a data de modificação do arquivo
+    def DataRemendo(self, Rem):
+        data = Rem.GetMetadataItem('TIFFTAG_DATETIME')
+        if data:
+            try:
+                return datetime.strptime(data.strip(), '%Y:%m:%d %H:%M:%S').timestamp()
+            except ValueError:
+                pass
+        arquivos = Rem.GetFileList()
+        try:
+            return os.path.getmtime(arquivos[0]) if arquivos else 0
+        except OSError: # fontes virtuais do GDAL (/vsicurl/, /vsizip/, ...)
+            return 0
+    
+    # Ordenar os remendos pela regra de prioridade
+    # 0: primeiro válido (ordem da lista), 1: melhor resolução, 2: mais recente (data obtida somente neste caso)
+    def OrdenarRemendos(self, remendos, prioridade):
+        if prioridade == 1:
+            return sorted(remendos, key = lambda rem: rem['xres']*rem['yres'])
+        elif prioridade == 2:
+            return sorted(remendos, key = lambda rem: -self.DataRemendo(rem['image']))
+        return remendos
+    
+    # Ler somente a janela das bandas do remendo que cobre a extensão (com margem para a interpolação)
+    def LerJanela(self, rem, n_bands, x_min, x_max, y_min, y_max, margem = 3):
+        lin_ini = max(int(floor((rem['origem'][1] - y_max)/rem['yres'])) - margem, 0)
+        lin_fim = min(int(ceil((rem['origem'][1] - y_min)/rem['yres'])) + margem, rem['rows'])
+        col_ini = max(int(floor((x_min - rem['origem'][0])/rem['xres'])) - margem, 0)
+        col_fim = min(int(ceil((x_max - rem['origem'][0])/rem['xres'])) + margem, rem['cols'])
+        # Janela com pelo menos 5x5 pixels (vizinhança da bicúbica junto às bordas do remendo)
+        lin_fim, col_fim = max(lin_fim, min(lin_ini + 5, rem['rows'])), max(col_fim, min(col_ini + 5, rem['cols']))
+        lin_ini, col_ini = min(lin_ini, max(lin_fim - 5, 0)), min(col_ini, max(col_fim - 5, 0))
+        bands = np.stack([rem['image'].GetRasterBand(k+1).ReadAsArray(col_ini, lin_ini, col_fim-col_ini, lin_fim-lin_ini) for k in range(n_bands)])
+        origem = (rem['origem'][0] + col_ini*rem['xres'], rem['origem'][1] - lin_ini*rem['yres'])
+        return bands, origem
+    
+    # Limiares por banda a partir do texto (ex.: '240' ou '240,,250'); bandas sem valor são ignoradas
+    def Limiares(self, texto, n_bands):
+        limiares = {}
+        for k, valor in enumerate(texto.split(',') if texto else []):
+            if valor.strip():
+                if k >= n_bands:
+                    raise QgsProcessingException(self.tr('More thresholds than image bands!', 'Mais limiares do que bandas da imagem!'))
+                try:
+                    limiares[k] = float(valor)
+                except ValueError:
+                    raise QgsProcessingException(self.tr('Invalid threshold: {}', 'Limiar inválido: {}').format(valor))
+        return limiares
+    
+    # Camada OGR em memória com os polígonos de máscara no SRC da imagem
+    def CamadaMascara(self, source, prj):
+        fonte = ogr.GetDriverByName('Memory').CreateDataSource('')
+        camada = fonte.CreateLayer('mascara', geom_type = ogr.wkbMultiPolygon)
+        crsDest = QgsCoordinateReferenceSystem(prj)
+        coordTransf = QgsCoordinateTransform(source.sourceCrs(), crsDest, QgsProject.instance()) if source.sourceCrs() != crsDest else None
+        for feature in source.getFeatures():
+            geom = feature.geometry()
+            if geom.isEmpty():
+                continue
+            if coordTransf:
+                geom.transform(coordTransf)
+            feat = ogr.Feature(camada.GetLayerDefn())
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+            camada.CreateFeature(feat)
+        return fonte
+    
+    # Máscara dos pixels de uma grade (faixa) cujos centros estão dentro dos polígonos de máscara
+    # Rasterização em memória: considera todas as partes e os buracos dos polígonos
+    def MascaraJanela(self, fonte, origem, resol_X, resol_Y, n_lin, n_col):
+        grade = gdal.GetDriverByName('MEM').Create('', n_col, n_lin, 1, gdal.GDT_Byte)
+        grade.SetGeoTransform([origem[0], resol_X, 0, origem[1], 0, -resol_Y])
+        gdal.RasterizeLayer(grade, [1], fonte.GetLayer(0), burn_values = [1])
+        mascara = grade.GetRasterBand(1).ReadAsArray().astype(bool)
+        grade = None
+        return mascara
+    
+    # Pesos da suavização (feathering): distância, em pixels, à borda da extensão do remendo, limitada a 1
+    def PesosBorda(self, X, Y, rem, largura, resol_X, resol_Y):
+        if largura <= 0:
+            return np.ones(X.shape)
+        dist_lin = np.minimum(Y - rem['lry'], rem['origem'][1] - Y)/resol_Y
+        dist_col = np.minimum(X - rem['origem'][0], rem['lrx'] - X)/resol_X
+        return np.clip(np.minimum(dist_lin, dist_col)/largura, 0, 1)
+    
+    # Valores ajustados ao tipo de dado da banda (arredondados e limitados nos tipos inteiros)
+    def AjustarTipo(self, Z, dtype):
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            return np.clip(np.round(Z), info.min, info.max).astype(dtype)
+        return Z.astype(dtype)
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
     
     def processAlgorithm(self, parameters, context, feedback):
         
@@ -227,13 +454,85 @@ class FillRasterwithPatches(QgsProcessingAlgorithm):
             context
         )
         
-        limiar = 240
-        reamostragem = 'nearest'
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
+        atualizar = self.parameterAsBool(
+            parameters,
+            self.INPLACE,
+            context
+        )
+        
+        limiar = self.parameterAsString(
+            parameters,
+            self.THRESHOLD,
+            context
+        )
+        
+        mascara_source = self.parameterAsSource(
+            parameters,
+            self.MASK,
+            context
+        )
+        
+        reamostragem = self.parameterAsEnum(
+            parameters,
+            self.RESAMPLING,
+            context
+        )
+        reamostragem = ['nearest','bilinear','bicubic'][reamostragem]
+        
+        largura = self.parameterAsInt(
+            parameters,
+            self.FEATHER,
+            context
+        )
+        
+        prioridade = self.parameterAsEnum(
+            parameters,
+            self.PRIORITY,
+            context
+        )
         
-        # Abrir Raster layer como array
-        image = gdal.Open(RasterIN)
-        prj=image.GetProjection()
-        CRS=osr.SpatialReference(wkt=prj)
+        # Imagem de saída: o próprio raster de entrada (atualização) ou uma cópia dele
+        if atualizar:
+            feedback.pushInfo(self.tr('Opening input raster for update...', 'Abrindo raster de entrada para atualização...'))
+            image = gdal.Open(RasterIN, gdal.GA_Update)
+            if image is None:
+                raise QgsProcessingException(self.tr('The input raster cannot be updated in place!', 'O raster de entrada não pode ser atualizado!'))
+            RGB_Output = RasterIN
+        else:
+            if not RGB_Output:
+                raise QgsProcessingException(self.tr('Choose the output file or the in-place update mode!', 'Escolha o arquivo de saída ou o modo de atualização do raster de entrada!'))
+            fonte = gdal.Open(RasterIN)
+            GDT = fonte.GetRasterBand(1).DataType
+            feedback.pushInfo(self.tr('Copying input raster...', 'Copiando raster de entrada...'))
+            gdal.GetDriverByName('GTiff').CreateCopy(RGB_Output, fonte, options = self.OpcoesGTiff(GDT, fonte.RasterCount, compressao, tiled, ladrilho))
+            fonte = None
+            image = gdal.Open(RGB_Output, gdal.GA_Update)
         geotransform = image.GetGeoTransform()
         n_bands = image.RasterCount # Número de bandas
         cols = image.RasterXSize # Number of columns
@@ -243,102 +542,114 @@ class FillRasterwithPatches(QgsProcessingAlgorithm):
         origem = (ulx, uly)
         resol_X = abs(xres)
         resol_Y = abs(yres)
-        feedback.pushInfo(self.tr('Opening Band R...', 'Abrindo Banda R...'))
-        band1 = image.GetRasterBand(1).ReadAsArray()
-        feedback.pushInfo(self.tr('Opening Band G...', 'Abrindo Banda G...'))
-        band2 = image.GetRasterBand(2).ReadAsArray()
-        feedback.pushInfo(self.tr('Opening Band B...', 'Abrindo Banda B...'))
-        band3 = image.GetRasterBand(3).ReadAsArray()
-        # Transparência
-        if n_bands == 4:
-            feedback.pushInfo(self.tr('Opening Band Alpha...', 'Abrindo Banda Alfa...'))
-            band4 = image.GetRasterBand(4).ReadAsArray()
-        Pixel_Nulo = image.GetRasterBand(1).GetNoDataValue()
+        bandas = [image.GetRasterBand(k+1) for k in range(n_bands)]
+        # Banda alfa (transparência): interpretação de cor alfa ou a 4ª banda de uma imagem RGBA
+        alfa = [k for k in range(n_bands) if bandas[k].GetColorInterpretation() == gdal.GCI_AlphaBand]
+        alfa = alfa[0] if alfa else (3 if n_bands == 4 else None)
+        dados = [k for k in range(n_bands) if k != alfa]
+        Pixel_Nulo = bandas[0].GetNoDataValue()
         if Pixel_Nulo == None:
             Pixel_Nulo = 0
-        image=None # Fechar imagem
+        limiares = self.Limiares(limiar, n_bands)
+        mascara_fonte = self.CamadaMascara(mascara_source, image.GetProjection()) if mascara_source is not None else None
         
-        # Número de pixels para processamento
-        TAM =  0
-        for Remendo in PatchesLayers:
-            Rem_Path = Remendo.dataProvider().dataSourceUri()
-            Rem = gdal.Open(Rem_Path)
-        #    Rem_cols = Rem.RasterXSize # Number of columns
-            Rem_rows = Rem.RasterYSize # Number of rows
-            TAM += Rem_rows
-
-        # Remendos
-        total = 100.0 / TAM
-        cont = 0
-        for Remendo in PatchesLayers:
-            feedback.pushInfo((self.tr('Processing Layer: {}', 'Processando Camada: {}')).format(Remendo))
-            Rem_Path = Remendo.dataProvider().dataSourceUri()
-            Rem = gdal.Open(Rem_Path)
-            ulx, xres, xskew, uly, yskew, yres  = Rem.GetGeoTransform()
-            Rem_origem = (ulx, uly)
-            Rem_resol_X = abs(xres)
-            Rem_resol_Y = abs(yres)
-            Rem_cols = Rem.RasterXSize # Number of columns
-            Rem_rows = Rem.RasterYSize # Number of rows
-            lrx = ulx + (Rem_cols * xres)
-            lry = uly + (Rem_rows * yres)
-            bbox = [ulx, lrx, lry, uly]
-            Rem_nulo = Rem.GetRasterBand(1).GetNoDataValue()
-            if Rem_nulo == None:
-                Rem_nulo = 0
-            Rem_band1 = Rem.GetRasterBand(1).ReadAsArray()
-            Rem_band2 = Rem.GetRasterBand(2).ReadAsArray()
-            Rem_band3 = Rem.GetRasterBand(3).ReadAsArray()
-
-            # Limites de Varredura
-            row_ini = int(round((origem[1]-uly)/resol_Y - 0.5))
-            row_fim = int(round((origem[1]-lry)/resol_Y - 0.5))
-            col_ini = int(round((ulx - origem[0])/resol_X - 0.5))
-            col_fim = int(round((lrx - origem[0])/resol_X - 0.5))
-            # Varrer Raster
-            if n_bands == 4:
-                for lin in range(row_ini, row_fim):
-                    for col in range(col_ini, col_fim):
-                        px_value = band4[lin][col]
-                        if px_value == 0 or band1[lin][col] > limiar: # Verificar Limiar
-                            X = origem[0] + resol_X*(col + 0.5)
-                            Y = origem[1] - resol_Y*(lin + 0.5)
-                            band1[lin][col] = self.Interpolar(X, Y, Rem_band1, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                            band2[lin][col] = self.Interpolar(X, Y, Rem_band2, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                            band3[lin][col] = self.Interpolar(X, Y, Rem_band3, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                    cont += 1
-                    feedback.setProgress(int(cont * total))
+        # Remendos (cada camada é aberta uma única vez)
+        remendos = self.AbrirRemendos(PatchesLayers)
+        for rem in remendos:
+            if rem['image'].RasterCount < len(dados):
+                raise QgsProcessingException(self.tr('The patch layer {} has fewer bands than the input raster!', 'A camada de remendo {} tem menos bandas do que o raster de entrada!').format(rem['nome']))
+        
+        remendos = self.OrdenarRemendos(remendos, prioridade)
+        
+        # Índice espacial das extensões dos remendos (o id da feição é o número do remendo na ordem de prioridade)
+        indice = QgsSpatialIndex()
+        for ind, rem in enumerate(remendos):
+            feat = QgsFeature(ind+1)
+            feat.setGeometry(QgsGeometry.fromRect(QgsRectangle(rem['origem'][0], rem['lry'], rem['lrx'], rem['origem'][1])))
+            indice.addFeature(feat)
+        
+        # Blocos da imagem de entrada dentro da extensão dos remendos
+        if remendos:
+            row_ini = max(int(floor((origem[1] - max([rem['origem'][1] for rem in remendos]))/resol_Y)), 0)
+            row_fim = min(int(ceil((origem[1] - min([rem['lry'] for rem in remendos]))/resol_Y)), rows)
+            col_ini = max(int(floor((min([rem['origem'][0] for rem in remendos]) - origem[0])/resol_X)), 0)
+            col_fim = min(int(ceil((max([rem['lrx'] for rem in remendos]) - origem[0])/resol_X)), cols)
+        else:
+            row_ini = row_fim = col_ini = col_fim = 0
+        lado = 1024
+        blocos = [(lin, col) for lin in range(row_ini, row_fim, lado) for col in range(col_ini, col_fim, lado)]
+        total = 100.0 / len(blocos) if blocos else 0
+        for cont, (lin_ini, col_ini) in enumerate(blocos):
+            if feedback.isCanceled():
+                break
+            n_lin = min(lado, row_fim - lin_ini)
+            n_col = min(lado, col_fim - col_ini)
+            # Remendos que tocam o bloco, em ordem de prioridade (consulta ao índice espacial)
+            retangulo = QgsRectangle(origem[0] + col_ini*resol_X,
+                                     origem[1] - (lin_ini + n_lin)*resol_Y,
+                                     origem[0] + (col_ini + n_col)*resol_X,
+                                     origem[1] - lin_ini*resol_Y)
+            contribuintes = sorted(indice.intersects(retangulo))
+            if not contribuintes:
+                continue
+            janela = [bd.ReadAsArray(col_ini, lin_ini, n_col, n_lin) for bd in bandas]
+            # Pixels a remendar: transparentes (ou nulos), acima dos limiares ou dentro dos polígonos de máscara
+            if alfa is not None:
+                mascara = janela[alfa] == 0
             else:
-                for lin in range(row_ini, row_fim):
-                    for col in range(col_ini, col_fim):
-                        px_value = band1[lin][col]
-                        if px_value == Pixel_Nulo or band1[lin][col] > limiar: # Verificar Limiar
-                            X = origem[0] + resol_X*(col + 0.5)
-                            Y = origem[1] - resol_Y*(lin + 0.5)
-                            band1[lin][col] = self.Interpolar(X, Y, Rem_band1, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                            band2[lin][col] = self.Interpolar(X, Y, Rem_band2, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                            band3[lin][col] = self.Interpolar(X, Y, Rem_band3, Rem_origem, Rem_resol_X, Rem_resol_Y, reamostragem, Rem_nulo)
-                    cont += 1
-                    feedback.setProgress(int(cont * total))
-            Rem = None # Fechar imagem
-
-        # Criar imagem RGB
-        feedback.pushInfo(self.tr('Saving Raster...', 'Salvando Raster...'))
-        GDT = gdal_array.NumericTypeCodeToGDALTypeCode(band1.dtype)
-        RGB = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, 3, GDT)
-        RGB.SetGeoTransform(geotransform)    # specify coords
-        RGB.SetProjection(CRS.ExportToWkt()) # export coords to file
-        feedback.pushInfo(self.tr('Writing Band R...', 'Escrevendo Banda R...'))
-        bandaR = RGB.GetRasterBand(1)
-        bandaR.WriteArray(band1)
-        feedback.pushInfo(self.tr('Writing Band G...', 'Escrevendo Banda G...'))
-        bandaG = RGB.GetRasterBand(2)
-        bandaG.WriteArray(band2)
-        feedback.pushInfo(self.tr('Writing Band B...', 'Escrevendo Banda B...'))
-        bandaB = RGB.GetRasterBand(3)
-        bandaB.WriteArray(band3)
-        RGB.FlushCache()   # Escrever no disco
-        RGB = None   # Salvar e fechar
+                mascara = janela[0] == Pixel_Nulo
+            sem_dados = mascara.copy()
+            for k in limiares:
+                mascara |= janela[k] > limiares[k] # Verificar Limiar
+            if mascara_fonte is not None:
+                mascara |= self.MascaraJanela(mascara_fonte, (origem[0] + col_ini*resol_X, origem[1] - lin_ini*resol_Y), resol_X, resol_Y, n_lin, n_col)
+            lin, col = np.nonzero(mascara)
+            X = origem[0] + resol_X*(col_ini + col + 0.5)
+            Y = origem[1] - resol_Y*(lin_ini + lin + 0.5)
+            sem_dados = sem_dados[lin, col]
+            remendado = False
+            # Cada pixel pendente é preenchido pelo primeiro remendo válido na ordem de prioridade
+            for ind in contribuintes:
+                if len(lin) == 0:
+                    break
+                rem = remendos[ind-1]
+                dentro = np.nonzero((X > rem['origem'][0]) & (X < rem['lrx']) & (Y > rem['lry']) & (Y < rem['origem'][1]))[0]
+                if len(dentro) == 0:
+                    continue
+                Xd, Yd = X[dentro], Y[dentro]
+                Rem_bands, Rem_origem = self.LerJanela(rem, len(dados), Xd.min(), Xd.max(), Yd.min(), Yd.max())
+                Z, validos = self.Interpolar(Xd, Yd, Rem_bands, Rem_origem, rem['xres'], rem['yres'], reamostragem, rem['nulo'])
+                validos = validos.all(axis=0)
+                dentro, Z = dentro[validos], Z[:, validos]
+                if len(dentro) == 0:
+                    continue
+                # Mistura com a imagem de entrada junto às bordas do remendo, somente onde ela tem dados
+                pesos = self.PesosBorda(X[dentro], Y[dentro], rem, largura, resol_X, resol_Y)
+                pesos[sem_dados[dentro]] = 1
+                lin_r, col_r = lin[dentro], col[dentro]
+                for n, k in enumerate(dados):
+                    valores = pesos*Z[n] + (1 - pesos)*janela[k][lin_r, col_r]
+                    janela[k][lin_r, col_r] = self.AjustarTipo(valores, janela[k].dtype)
+                # Pixels remendados passam a ser opacos
+                if alfa is not None:
+                    janela[alfa][lin_r, col_r] = np.iinfo(janela[alfa].dtype).max if np.issubdtype(janela[alfa].dtype, np.integer) else 255
+                remendado = True
+                # Retirar os pixels preenchidos da lista de pendentes
+                pendentes = np.ones(len(lin), dtype=bool)
+                pendentes[dentro] = False
+                lin, col, X, Y, sem_dados = lin[pendentes], col[pendentes], X[pendentes], Y[pendentes], sem_dados[pendentes]
+            if remendado:
+                for k in range(n_bands):
+                    bandas[k].WriteArray(janela[k], col_ini, lin_ini)
+            feedback.setProgress(int((cont+1) * total))
+        for rem in remendos:
+            rem['image'] = None # Fechar imagem
+        
+        if piramides:
+            feedback.pushInfo(self.tr('Building overviews...', 'Criando pirâmides...'))
+            self.CriarPiramides(image)
+        image.FlushCache()   # Escrever no disco
+        image = None   # Salvar e fechar
         
         feedback.pushInfo(self.tr('Operation completed successfully!', 'Operação finalizada com sucesso!'))
         feedback.pushInfo('Leandro França - Eng Cart')
@@ -44,15 +44,17 @@ from qgis.core import (QgsProcessing,
                        QgsApplication,
                        QgsProject,
                        QgsRasterLayer,
+                       QgsRectangle,
+                       QgsSpatialIndex,
                        QgsCoordinateTransform,
                        QgsCoordinateReferenceSystem)
 import gdal
-from osgeo import osr, gdal_array
-from itertools import combinations
-from matplotlib import path
+from osgeo import osr, gdal_array, ogr
 import numpy as np
 from pyproj.crs import CRS
 from math import floor, ceil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading, os
 
 class MosaicRaster(QgsProcessingAlgorithm):
 
@@ -112,7 +114,14 @@ class MosaicRaster(QgsProcessingAlgorithm):
     RESAMPLING = 'RESAMPLING'
     CLIP = 'CLIP'
     FRAME = 'FRAME'
+    MEMORY = 'MEMORY'
+    WORKERS = 'WORKERS'
+    FORMAT = 'FORMAT'
     MOSAIC = 'MOSAIC'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -147,7 +156,8 @@ class MosaicRaster(QgsProcessingAlgorithm):
                  self.tr('Average', 'Média'),
                  self.tr('Median', 'Mediana'),
                  self.tr('Maximum', 'Máximo'),
-                 self.tr('Minimum', 'Mínimo')]
+                 self.tr('Minimum', 'Mínimo'),
+                 self.tr('Feathering (weighted by distance to edge)', 'Suavização (ponderada pela distância à borda)')]
         
         self.addParameter(
             QgsProcessingParameterEnum(
@@ -197,12 +207,80 @@ class MosaicRaster(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MEMORY,
+                self.tr('Memory limit (MB)', 'Limite de memória (MB)'),
+                type =0, #Double = 1 and Integer = 0
+                defaultValue = 512,
+                minValue = 16
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Maximum number of workers (CPU cores)', 'Número máximo de processos (núcleos de CPU)'),
+                type =0, #Double = 1 and Integer = 0
+                defaultValue = os.cpu_count() or 1,
+                minValue = 1
+            )
+        )
+        
+        formatos = [self.tr('GeoTIFF (resample pixel by pixel)', 'GeoTIFF (reamostrar pixel a pixel)'),
+                    self.tr('Virtual mosaic (VRT)', 'Mosaico virtual (VRT)'),
+                    self.tr('Virtual mosaic materialized to GeoTIFF', 'Mosaico virtual materializado em GeoTIFF')]
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.FORMAT,
+                self.tr('Output format', 'Formato de saída'),
+				options = formatos,
+                defaultValue= 0
+            )
+        )
+        
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 self.MOSAIC,
                 self.tr('Mosaic', 'Mosaico'),
-                fileFilter = '.tif'
+                fileFilter = 'GeoTIFF (*.tif);;VRT (*.vrt)'
             )
         )
         
@@ -214,67 +292,299 @@ class MosaicRaster(QgsProcessingAlgorithm):
             )
         )
     
-    # Função de Interpolação
+    # Função de Interpolação (vetorizada)
+    # X e Y são arrays com as coordenadas dos centros dos pixels de destino.
+    # Retorna os valores interpolados e a máscara dos pixels válidos (não nulos).
     def Interpolar(self, X, Y, BAND, origem, resol_X, resol_Y, metodo, nulo):
+        nlin, ncol = BAND.shape
+        I = (origem[1]-Y)/resol_Y - 0.5
+        J = (X - origem[0])/resol_X - 0.5
         if metodo == 'nearest':
-            linha = int(round((origem[1]-Y)/resol_Y - 0.5))
-            coluna = int(round((X - origem[0])/resol_X - 0.5))
-            if BAND[linha][coluna] != nulo:
-                return float(BAND[linha][coluna])
-            else:
-                return nulo
+            linha = np.clip(np.round(I).astype(int), 0, nlin-1)
+            coluna = np.clip(np.round(J).astype(int), 0, ncol-1)
+            Z = BAND[linha, coluna]
+            validos = Z != nulo
+            return Z.astype(float), validos
         elif metodo == 'bilinear':
-            nlin = len(BAND)
-            ncol = len(BAND[0])
-            I = (origem[1]-Y)/resol_Y - 0.5
-            J = (X - origem[0])/resol_X - 0.5
-            di = I - floor(I)
-            dj = J - floor(J)
-            if I<0:
-                I=0
-            if I>nlin-1:
-                I=nlin-1
-            if J<0:
-                J=0
-            if J>ncol-1:
-                J=ncol-1
-            if (BAND[int(floor(I)):int(ceil(I))+1, int(floor(J)):int(ceil(J))+1] == nulo).sum() == 0:
-                Z = (1-di)*(1-dj)*BAND[int(floor(I))][int(floor(J))] + (1-dj)*di*BAND[int(ceil(I))][int(floor(J))] + (1-di)*dj*BAND[int(floor(I))][int(ceil(J))] + di*dj*BAND[int(ceil(I))][int(ceil(J))]
-                return float(Z)
-            else:
-                return nulo
+            di = I - np.floor(I)
+            dj = J - np.floor(J)
+            I = np.clip(I, 0, nlin-1)
+            J = np.clip(J, 0, ncol-1)
+            I0, I1 = np.floor(I).astype(int), np.ceil(I).astype(int)
+            J0, J1 = np.floor(J).astype(int), np.ceil(J).astype(int)
+            Z00, Z10 = BAND[I0, J0], BAND[I1, J0]
+            Z01, Z11 = BAND[I0, J1], BAND[I1, J1]
+            validos = (Z00 != nulo) & (Z10 != nulo) & (Z01 != nulo) & (Z11 != nulo)
+            Z = (1-di)*(1-dj)*Z00 + (1-dj)*di*Z10 + (1-di)*dj*Z01 + di*dj*Z11
+            return Z, validos
         elif metodo == 'bicubic':
-            nlin = len(BAND)
-            ncol = len(BAND[0])
-            I = (origem[1]-Y)/resol_Y - 0.5
-            J = (X - origem[0])/resol_X - 0.5
-            di = I - floor(I)
-            dj = J - floor(J)
-            I=int(floor(I))
-            J=int(floor(J))
-            if I<2:
-                I=2
-            if I>nlin-3:
-                I=nlin-3
-            if J<2:
-                J=2
-            if J>ncol-3:
-                J=ncol-3
-            if (BAND[I-1:I+3, J-1:J+3] == nulo).sum() == 0:
-                MatrInv = np.mat([[-1/6, 0.5, -0.5, 1/6], [ 0.5, -1., 0.5, 0.], [-1/3, -0.5,  1., -1/6], [ 0., 1., 0., 0.]]) # resultado da inversa: (np.mat([[-1, 1, -1, 1], [0, 0, 0, 1], [1, 1, 1, 1], [8, 4, 2, 1]])).I #
-                MAT  = np.mat([ [BAND[I-1, J-1],  BAND[I-1, J], BAND[I-1, J+1], BAND[I-2, J+2]],
-                                [BAND[I, J-1],    BAND[I, J],   BAND[I, J+1],   BAND[I, J+2]],
-                                [BAND[I+1, J-1],  BAND[I+1, J], BAND[I+1, J+1], BAND[I+1, J+2]],
-                                [BAND[I+2, J-1],  BAND[I+2, J], BAND[I+2, J+1], BAND[I+2, J+2]]])
-                coef = MatrInv*MAT.transpose()
-                # Horizontal
-                pi = coef[0,:]*pow(dj,3)+coef[1,:]*pow(dj,2)+coef[2,:]*dj+coef[3,:]
-                # Vertical
-                coef2 = MatrInv*pi.transpose()
-                pj = coef2[0]*pow(di,3)+coef2[1]*pow(di,2)+coef2[2]*di+coef2[3]
-                return float(pj)
-            else:
-                return nulo
+            di = I - np.floor(I)
+            dj = J - np.floor(J)
+            I = np.clip(np.floor(I).astype(int), 2, nlin-3)
+            J = np.clip(np.floor(J).astype(int), 2, ncol-3)
+            MatrInv = np.array([[-1/6, 0.5, -0.5, 1/6], [ 0.5, -1., 0.5, 0.], [-1/3, -0.5,  1., -1/6], [ 0., 1., 0., 0.]]) # resultado da inversa: (np.mat([[-1, 1, -1, 1], [0, 0, 0, 1], [1, 1, 1, 1], [8, 4, 2, 1]])).I #
+            # Pesos dos 4 vizinhos na vertical e na horizontal
+            Wi = np.stack((di**3, di**2, di, np.ones(di.shape)), axis=-1) @ MatrInv
+            Wj = np.stack((dj**3, dj**2, dj, np.ones(dj.shape)), axis=-1) @ MatrInv
+            desloc = np.arange(-1, 3)
+            MAT = BAND[(I[:,np.newaxis] + desloc)[:,:,np.newaxis], (J[:,np.newaxis] + desloc)[:,np.newaxis,:]]
+            validos = (MAT != nulo).all(axis=(1,2))
+            Z = np.einsum('ni,nij,nj->n', Wi, MAT.astype(float), Wj)
+            return Z, validos
+    
+    # Máscara dos pixels de uma grade (bloco) cujos centros estão dentro do polígono
+    # Rasterização em memória: considera todas as partes e os buracos do polígono
+    def MascaraPoligono(self, geom, origem, resol_X, resol_Y, n_lin, n_col):
+        fonte = ogr.GetDriverByName('Memory').CreateDataSource('')
+        camada = fonte.CreateLayer('poligono', geom_type = ogr.wkbMultiPolygon)
+        feat = ogr.Feature(camada.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        camada.CreateFeature(feat)
+        grade = gdal.GetDriverByName('MEM').Create('', n_col, n_lin, 1, gdal.GDT_Byte)
+        grade.SetGeoTransform([origem[0], resol_X, 0, origem[1], 0, -resol_Y])
+        gdal.RasterizeLayer(grade, [1], camada, burn_values = [1])
+        mascara = grade.GetRasterBand(1).ReadAsArray().astype(bool)
+        grade = None
+        fonte = None
+        return mascara
+    
+    # Pixels do bloco cobertos por cada imagem (centro do pixel dentro da extensão da imagem)
+    def CoberturaBloco(self, contribuintes, caixas, moldura_geom, origem, resol_X, resol_Y, n_lin, n_col):
+        X = origem[0] + resol_X*(np.arange(n_col) + 0.5)
+        Y = origem[1] - resol_Y*(np.arange(n_lin) + 0.5)
+        cobertura = np.zeros((len(contribuintes), n_lin, n_col), dtype=bool)
+        for n, img in enumerate(contribuintes):
+            box = caixas[img]
+            dentro_lin = (Y > box.yMinimum()) & (Y < box.yMaximum())
+            dentro_col = (X > box.xMinimum()) & (X < box.xMaximum())
+            cobertura[n] = dentro_lin[:,np.newaxis] & dentro_col[np.newaxis,:]
+        if moldura_geom is not None:
+            cobertura &= self.MascaraPoligono(moldura_geom, origem, resol_X, resol_Y, n_lin, n_col)
+        return cobertura
+    
+    # Pesos para a suavização (feathering): distância do centro do pixel à borda da extensão de cada imagem
+    def PesosBorda(self, contribuintes, caixas, origem, resol_X, resol_Y, n_lin, n_col):
+        X = origem[0] + resol_X*(np.arange(n_col) + 0.5)
+        Y = origem[1] - resol_Y*(np.arange(n_lin) + 0.5)
+        pesos = np.zeros((len(contribuintes), n_lin, n_col))
+        for n, img in enumerate(contribuintes):
+            box = caixas[img]
+            dist_lin = np.minimum(Y - box.yMinimum(), box.yMaximum() - Y)
+            dist_col = np.minimum(X - box.xMinimum(), box.xMaximum() - X)
+            pesos[n] = np.clip(np.minimum(dist_lin[:,np.newaxis], dist_col[np.newaxis,:]), 0, None)
+        return pesos
+    
+    # Valor agregado ao longo do eixo das imagens (valores ausentes ou nulos como NaN)
+    # 1: média, 2: mediana, 3: máximo, 4: mínimo, 5: média ponderada pela distância à borda
+    def Agregar(self, pilha, sobrep, pesos = None):
+        validos = ~np.isnan(pilha)
+        n = validos.sum(axis=0)
+        vazio = np.full(n.shape, np.nan)
+        if sobrep == 1:
+            return np.divide(np.where(validos, pilha, 0).sum(axis=0), n, out = vazio, where = n > 0)
+        elif sobrep == 2:
+            ordenado = np.sort(pilha, axis=0) # NaN ficam no final
+            meio1 = np.take_along_axis(ordenado, np.maximum((n-1)//2, 0)[np.newaxis], axis=0)[0]
+            meio2 = np.take_along_axis(ordenado, np.minimum(n//2, len(pilha)-1)[np.newaxis], axis=0)[0]
+            return np.where(n > 0, (meio1 + meio2)/2, np.nan)
+        elif sobrep == 3:
+            return np.fmax.reduce(pilha, axis=0)
+        elif sobrep == 4:
+            return np.fmin.reduce(pilha, axis=0)
+        elif sobrep == 5:
+            pesos = np.where(validos, pesos, 0)
+            soma_pesos = pesos.sum(axis=0)
+            return np.divide((np.where(validos, pilha, 0)*pesos).sum(axis=0), soma_pesos, out = vazio, where = soma_pesos > 0)
+    
+    # Ler somente a janela da banda que cobre a extensão (com margem para a interpolação)
+    def LerJanela(self, img, k, x_min, x_max, y_min, y_max, margem = 3):
+        lin_ini = max(int(floor((img['origem'][1] - y_max)/img['yres'])) - margem, 0)
+        lin_fim = min(int(ceil((img['origem'][1] - y_min)/img['yres'])) + margem, img['rows'])
+        col_ini = max(int(floor((x_min - img['origem'][0])/img['xres'])) - margem, 0)
+        col_fim = min(int(ceil((x_max - img['origem'][0])/img['xres'])) + margem, img['cols'])
+        if lin_fim <= lin_ini or col_fim <= col_ini:
+            return None, None
+        # Janela com pelo menos 5x5 pixels (vizinhança da bicúbica junto às bordas da imagem)
+        lin_fim, col_fim = max(lin_fim, min(lin_ini + 5, img['rows'])), max(col_fim, min(col_ini + 5, img['cols']))
+        lin_ini, col_ini = min(lin_ini, max(lin_fim - 5, 0)), min(col_ini, max(col_fim - 5, 0))
+        band = img['image'].GetRasterBand(k+1).ReadAsArray(col_ini, lin_ini, col_fim-col_ini, lin_fim-lin_ini)
+        origem = (img['origem'][0] + col_ini*img['xres'], img['origem'][1] - lin_ini*img['yres'])
+        return band, origem
+    
+    # Conexões GDAL com as imagens do bloco, próprias de cada processo de trabalho (thread)
+    def ImagensThread(self, imgs, contribuintes):
+        if not hasattr(self.local, 'images'):
+            self.local.images = {}
+        images = self.local.images
+        # Manter abertas apenas as imagens do bloco atual
+        for img in list(images):
+            if img not in contribuintes:
+                images[img] = None
+                del images[img]
+        for img in contribuintes:
+            if img not in images:
+                images[img] = gdal.Open(imgs[img]['path'])
+        return images
+    
+    # Escrever no raster de saída os blocos das tarefas concluídas
+    def EscreverBlocos(self, Driver, tarefas):
+        for tarefa in tarefas:
+            lin_ini, col_ini, resultado = tarefa.result()
+            for k in resultado:
+                Driver.GetRasterBand(k+1).WriteArray(resultado[k], col_ini, lin_ini)
+        return len(tarefas)
+    
+    # Mosaico virtual (VRT) na grade de saída, com prioridade da primeira imagem, valor nulo e recorte pela moldura; retorna a VRT das fontes
+    def MosaicoVirtual(self, vrt, lista, limites, resol_X, resol_Y, reamostragem, valor_nulo, define_nulo, moldura_geom, prj):
+        metodo = {'nearest': 'nearest', 'bilinear': 'bilinear', 'bicubic': 'cubic'}[reamostragem]
+        fontes = vrt if moldura_geom is None else os.path.splitext(vrt)[0] + '_fontes.vrt'
+        # A última fonte da VRT é desenhada por cima: inverter a lista para a primeira imagem ter prioridade.
+        # Sem valor nulo nas fontes, o pixel nulo da primeira imagem que cobre o local permanece nulo,
+        # sem passar para a imagem seguinte, como na saída GeoTIFF pixel a pixel
+        opcoes = gdal.BuildVRTOptions(outputBounds = limites,
+                                      xRes = resol_X,
+                                      yRes = resol_Y,
+                                      resampleAlg = metodo,
+                                      srcNodata = 'None',
+                                      VRTNodata = valor_nulo if define_nulo else 'None')
+        VRT = gdal.BuildVRT(fontes, lista[::-1], options = opcoes)
+        if VRT is None:
+            raise QgsProcessingException(self.tr('Error building the virtual mosaic!', 'Erro ao construir o mosaico virtual!'))
+        VRT = None
+        if moldura_geom is not None:
+            # Recorte pela moldura: VRT de warp com linha de corte na mesma grade (guardada dentro da própria VRT)
+            corte = '/vsimem/moldura_{}.geojson'.format(id(self))
+            SRC = osr.SpatialReference()
+            SRC.ImportFromWkt(prj)
+            fonte = ogr.GetDriverByName('GeoJSON').CreateDataSource(corte)
+            camada = fonte.CreateLayer('moldura', SRC, ogr.wkbMultiPolygon)
+            feat = ogr.Feature(camada.GetLayerDefn())
+            feat.SetGeometry(ogr.CreateGeometryFromWkt(moldura_geom.asWkt()))
+            camada.CreateFeature(feat)
+            feat = None
+            fonte = None
+            opcoes = gdal.WarpOptions(format = 'VRT',
+                                      outputBounds = limites,
+                                      xRes = resol_X,
+                                      yRes = resol_Y,
+                                      cutlineDSName = corte,
+                                      srcNodata = valor_nulo,
+                                      dstNodata = valor_nulo)
+            try:
+                VRT = gdal.Warp(vrt, fontes, options = opcoes)
+            finally:
+                gdal.Unlink(corte)
+            if VRT is None:
+                raise QgsProcessingException(self.tr('Error clipping the virtual mosaic by the frame!', 'Erro ao cortar o mosaico virtual pela moldura!'))
+            VRT = None
+        return fontes
+
+    # Mosaicar um bloco para um grupo de bandas
+    def MosaicarBloco(self, bloco, bandas, param):
+        lin_ini, col_ini, n_lin_bloco, n_col_bloco, contribuintes = bloco
+        imgs = param['imgs']
+        origem = param['origem']
+        resol_X = param['resol_X']
+        resol_Y = param['resol_Y']
+        sobrep = param['sobrep']
+        valor_nulo = param['valor_nulo']
+        inteiro = param['inteiro']
+        images = self.ImagensThread(imgs, contribuintes)
+        bloco_origem = (origem[0] + col_ini*resol_X, origem[1] - lin_ini*resol_Y)
+        # Pixels do bloco a serem interpolados de cada imagem
+        pixels = {}
+        if contribuintes:
+            cobertura = self.CoberturaBloco(contribuintes, param['caixas'], param['moldura_geom'], bloco_origem, resol_X, resol_Y, n_lin_bloco, n_col_bloco)
+            if sobrep == 0: # apenas a primeira imagem da lista que cobre o pixel
+                coberto = cobertura.any(axis=0)
+                primeira = np.argmax(cobertura, axis=0)
+                for n, img in enumerate(contribuintes):
+                    pixels[img] = np.nonzero(coberto & (primeira == n))
+            else: # todas as imagens que cobrem o pixel
+                for n, img in enumerate(contribuintes):
+                    pixels[img] = np.nonzero(cobertura[n])
+                if sobrep == 5:
+                    pesos = self.PesosBorda(contribuintes, param['caixas'], bloco_origem, resol_X, resol_Y, n_lin_bloco, n_col_bloco)
+            cobertura = None
+
+        resultado = {}
+        for k in bandas:
+            # Criar Array do bloco do mosaico
+            banda = np.ones((n_lin_bloco, n_col_bloco), dtype = param['tipo']) * (int(valor_nulo) if inteiro else valor_nulo)
+            if sobrep != 0:
+                # Pilha (imagens x linhas x colunas) com os valores interpolados e NaN nos pixels sem valor
+                pilha = np.full((len(contribuintes), n_lin_bloco, n_col_bloco), np.nan)
+            for n, img in enumerate(contribuintes):
+                lin, col = pixels[img]
+                if len(lin) == 0:
+                    continue
+                # Ler somente a janela da banda que cobre os pixels da imagem
+                img_band, img_origem = self.LerJanela(dict(imgs[img], image = images[img]), k,
+                                                      bloco_origem[0] + col.min()*resol_X,
+                                                      bloco_origem[0] + (col.max()+1)*resol_X,
+                                                      bloco_origem[1] - (lin.max()+1)*resol_Y,
+                                                      bloco_origem[1] - lin.min()*resol_Y)
+                if img_band is None:
+                    continue
+                X = bloco_origem[0] + resol_X*(col + 0.5)
+                Y = bloco_origem[1] - resol_Y*(lin + 0.5)
+                Interpolado, validos = self.Interpolar(X, Y,
+                                          img_band,
+                                          img_origem,
+                                          imgs[img]['xres'],
+                                          imgs[img]['yres'],
+                                          param['reamostragem'],
+                                          valor_nulo)
+                img_band = None
+                if sobrep == 0: # Inserir na banda (se inteiro, arredondar e limitar ao intervalo do tipo)
+                    banda[lin[validos], col[validos]] = self.AjustarTipo(Interpolado[validos], param['tipo'])
+                else:
+                    pilha[n, lin[validos], col[validos]] = Interpolado[validos]
+            if sobrep != 0 and contribuintes:
+                # Reduzir a pilha ao longo do eixo das imagens e inserir na banda (se inteiro, arredondar e limitar ao intervalo do tipo)
+                result = self.Agregar(pilha, sobrep, pesos if sobrep == 5 else None)
+                validos = ~np.isnan(result)
+                banda[validos] = self.AjustarTipo(result[validos], param['tipo'])
+            pilha = None
+            resultado[k] = banda
+        return lin_ini, col_ini, resultado
+    
+    # Valores ajustados ao tipo de dado da banda (arredondados e limitados nos tipos inteiros,
+    # pois a interpolação bicúbica pode ultrapassar o intervalo do tipo)
+    def AjustarTipo(self, Z, dtype):
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            return np.clip(np.round(Z), info.min, info.max).astype(dtype)
+        return Z.astype(dtype)
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
     
     def processAlgorithm(self, parameters, context, feedback):
         
@@ -333,6 +643,24 @@ class MosaicRaster(QgsProcessingAlgorithm):
             if vlayer is None:
                 raise QgsProcessingException(self.invalidSourceError(parameters, self.FRAME))
         
+        memoria = self.parameterAsInt( 
+            parameters,
+            self.MEMORY,
+            context
+        )
+        
+        n_proc = self.parameterAsInt( 
+            parameters,
+            self.WORKERS,
+            context
+        )
+        
+        formato = self.parameterAsEnum(
+            parameters,
+            self.FORMAT,
+            context
+        )
+        
         # output
         
         Output = self.parameterAsFileOutput( 
@@ -347,6 +675,42 @@ class MosaicRaster(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
+        
+        # O mosaico virtual só reproduz a sobreposição "primeiro" (as fontes da VRT são desenhadas umas sobre as outras)
+        if formato != 0 and sobrep != 0:
+            raise QgsProcessingException(self.tr('The virtual mosaic (VRT) only supports the "First" overlap option!', 'O mosaico virtual (VRT) só permite a opção de sobreposição "Primeiro"!'))
+        # Extensão do arquivo de saída compatível com o formato escolhido
+        if formato != 0:
+            extensoes = ('.vrt',) if formato == 1 else ('.tif', '.tiff')
+            if os.path.splitext(Output)[1].lower() not in extensoes:
+                raise QgsProcessingException(self.tr('The output file must have the {} extension for the chosen output format!'.format(extensoes[0]),
+                                                     'O arquivo de saída deve ter a extensão {} para o formato de saída escolhido!'.format(extensoes[0])))
         
         lista = []
         for raster_lyr in rasters:
@@ -418,10 +782,10 @@ class MosaicRaster(QgsProcessingAlgorithm):
             y_max = moldura_rect.yMaximum()
             x_min = moldura_rect.xMinimum()
             x_max = moldura_rect.xMaximum()
-        else: # Mesclar geometrias e obter a extensão
-            new_geom = QgsGeometry()
-            new_geom = new_geom.unaryUnion(geoms)
-            extensao = new_geom.boundingBox()
+        else: # Combinar as extensões das imagens
+            extensao = QgsRectangle(geoms[0].boundingBox())
+            for geom in geoms[1:]:
+                extensao.combineExtentWith(geom.boundingBox())
             # Coodenadas máxima e mínima da extensão
             y_min = extensao.yMinimum()
             y_max = extensao.yMaximum()
@@ -473,241 +837,149 @@ class MosaicRaster(QgsProcessingAlgorithm):
         origem = (ulx, uly)
         resol_X = abs(xres)
         resol_Y = abs(yres)
-        # Numeração das Imagens
-        valores = list(range(1,len(lista)+1))
-
-        # Definição de áreas de varredura
-        feedback.pushInfo(self.tr('Defining mosaic filling areas...', 'Definindo áreas de preenchimento do mosaico...'))
-        
-        if sobrep != 0:
-        # Gerar combinações dos Rasters
-            combs = []
-            feedback.pushInfo(self.tr('Creating combinations...', 'Gerando combinações...'))
-            for k in range(1,5):
-                combs += list(combinations(valores,k))
-                if feedback.isCanceled():
-                    break
-            # Armazenar geometrias exclusivas de cada combinação
-            classes = {}
-            feedback.pushInfo(self.tr('Indentifying combinations...', 'Identificando combinações...'))
-            Percent = 100.0/(len(combs))
-            current = 0
-            
-            for comb in combs:
-                if len(comb)==1:
-                    geom1 = geoms[comb[0]-1]
-                    lista_outras = []
-                    for geom in geoms:
-                        if geom1 != geom:
-                            lista_outras += [geom]
-                    outras = QgsGeometry()
-                    outras = outras.unaryUnion(lista_outras)
-                    diferença = geom1.difference(outras)
-                    if not diferença.isEmpty():
-                        classes[comb] = {'geom': diferença}
-                elif len(comb) < len(valores):
-                    intersecao = geoms[comb[0]-1]
-                    sentinela = True
-                    for ind in comb[1:]:
-                        geom = geoms[ind-1]
-                        if geom.intersects(intersecao):
-                            intersecao = intersecao.intersection(geom)
-                        else:
-                            sentinela = False
-                            continue
-                    lista_outras = []
-                    for valor in valores:
-                        if valor not in comb:
-                            lista_outras += [geoms[valor-1]]
-                    outras = QgsGeometry()
-                    outras = outras.unaryUnion(lista_outras)
-                    if sentinela:
-                        diferença = intersecao.difference(outras)
-                        if not diferença.isEmpty():
-                            classes[comb] = {'geom': diferença}
-                else:
-                    intersecao = geoms[comb[0]-1]
-                    sentinela = True
-                    for ind in comb[1:]:
-                        geom = geoms[ind-1]
-                        if geom.intersects(intersecao):
-                            intersecao = intersecao.intersection(geom)
-                        else:
-                            sentinela = False
-                            continue
-                    if sentinela:
-                        classes[comb] = {'geom': intersecao}
-                if feedback.isCanceled():
-                    break
-                current += 1
-                feedback.setProgress(int(current * Percent))
-        else:
-            # Gerar geometrias por área sem cálculo de sobreposição ("first")
-            combs = np.array(valores)[:,np.newaxis]
-            classes = {}
-            acumulado = geoms[combs[0][0]-1]
-            classes[(1,)] = {'geom': acumulado}
-            for k in range(1, len(combs)):
-                comb = combs[k]
-                geom = geoms[comb[0]-1]
-                diferenca = geom.difference(acumulado)
-                classes[(comb[0],)] = {'geom': diferenca}
-                acumulado = acumulado.combine(geom)
-                if feedback.isCanceled():
-                    break
+        if not moldura:
+            moldura_geom = None
 
-        # Gerar lista com os valores classificados
-        Percent = 100.0/(len(classes))
-        current = 0
-        for classe in classes:
-            feedback.pushInfo((self.tr('Classifying class {}...', 'Classificando classe {}...')).format(str(classe)))
-            geom = classes[classe]['geom']
-            if moldura:
-                geom = geom.intersection(moldura_geom)
-            if geom.type() == 2:
-                if geom.isMultipart():
-                    coords = geom.asMultiPolygon()[0][0]
-                else:
-                    coords = geom.asPolygon()[0]
+        # Mosaico virtual (VRT), opcionalmente materializado em GeoTIFF
+        if formato != 0:
+            if formato == 1:
+                vrt = Output
             else:
-                del classes[classe]
-                continue
-            caminho = []
-            for ponto in coords:
-                linha = (origem[1]-ponto.y())/resol_Y
-                coluna = (ponto.x() - origem[0])/resol_X
-                caminho += [(linha, coluna)]
-            p = path.Path(caminho)
-            box = geom.boundingBox()
-            uly = box.yMaximum()
-            lry = box.yMinimum()
-            ulx = box.xMinimum()
-            lrx = box.xMaximum()
-            # Limites de Varredura
-            row_ini = int(round((origem[1]-uly)/resol_Y - 0.5))-1
-            row_fim = int(round((origem[1]-lry)/resol_Y - 0.5))+1
-            col_ini = int(round((ulx - origem[0])/resol_X - 0.5))-1
-            col_fim = int(round((lrx - origem[0])/resol_X - 0.5))+1
-            lin, col = np.meshgrid(np.arange(row_ini, row_fim),np.arange(col_ini, col_fim))
-            LIN = lin.flatten()[:,np.newaxis] + 0.5 # centro do pixel
-            COL = col.flatten()[:,np.newaxis] + 0.5
-            pixels_center = np.hstack((LIN, COL))
-            # Verificando pixels dentro de poligono
-            flags = p.contains_points(pixels_center)
-            pixels_x = LIN.flatten()*flags
-            pixels_y = COL.flatten()*flags
-            pixels_x = (pixels_x[pixels_x>0] - 0.5).astype('int')[:,np.newaxis]
-            pixels_y = (pixels_y[pixels_y>0] - 0.5).astype('int')[:,np.newaxis]
-            pixels = np.hstack((pixels_x, pixels_y))
-            classes[classe]['pixels'] = pixels
-            current += 1
-            feedback.setProgress(int(current * Percent))
+                vrt = '/vsimem/mosaico_{}.vrt'.format(id(self))
+            feedback.pushInfo(self.tr('Building virtual mosaic...', 'Construindo mosaico virtual...'))
+            fontes = self.MosaicoVirtual(vrt, lista, (x_min, y_min, x_max, y_max), resol_X, resol_Y, reamostragem,
+                                         valor_nulo, NULO != -1, moldura_geom, prj)
+            if formato == 2:
+                feedback.pushInfo(self.tr('Materializing virtual mosaic...', 'Materializando mosaico virtual...'))
+                def progresso(completo, msg, dados):
+                    feedback.setProgress(int(100*completo))
+                    return 0 if feedback.isCanceled() else 1
+                opcoes = gdal.TranslateOptions(format = 'GTiff',
+                                               creationOptions = self.OpcoesGTiff(GDT, n_bands, compressao, tiled, ladrilho),
+                                               callback = progresso)
+                Driver = gdal.Translate(Output, vrt, options = opcoes)
+                if piramides and Driver is not None:
+                    self.CriarPiramides(Driver)
+                Driver = None
+                for arq in {vrt, fontes}:
+                    gdal.Unlink(arq)
+            feedback.pushInfo(self.tr('Operation completed successfully!', 'Operação finalizada com sucesso!'))
+            feedback.pushInfo('Leandro França - Eng Cart')
+            self.CAMINHO = Output
+            self.CARREGAR = Carregar
+            return {self.MOSAIC: Output}
+
+        # Índice espacial das extensões das imagens (o id da feição é o número da imagem)
+        feedback.pushInfo(self.tr('Indexing raster footprints...', 'Indexando extensões dos rasters...'))
+        indice = QgsSpatialIndex()
+        caixas = {}
+        for img, geom in enumerate(geoms):
+            feat = QgsFeature(img+1)
+            feat.setGeometry(geom)
+            indice.addFeature(feat)
+            caixas[img+1] = geom.boundingBox()
+
+        # Metadados das imagens (cada processo de trabalho abre as suas próprias conexões GDAL)
+        imgs = {}
+        for img, img_path in enumerate(lista):
+            image = gdal.Open(img_path)
+            ulx, xres, xskew, uly, yskew, yres  = image.GetGeoTransform()
+            imgs[img+1] = {'path': img_path,
+                           'xres': abs(xres),
+                           'yres': abs(yres),
+                           'origem': (ulx, uly),
+                           'cols': image.RasterXSize,
+                           'rows': image.RasterYSize}
+            image = None
+
+        # Tipo do dado de saída
+        tipo = gdal_array.GDALTypeCodeToNumericTypeCode(GDT)
+        inteiro = True if GDT in (gdal.GDT_Byte,
+                                  gdal.GDT_UInt16,
+                                  gdal.GDT_Int16,
+                                  gdal.GDT_UInt32,
+                                  gdal.GDT_Int32) else False
+
+        # Tamanho dos blocos a partir do limite de memória (dividido entre os processos)
+        # bytes por pixel de saída: blocos de saída e resultado da agregação de todas as bandas da tarefa (no máximo todas
+        # as bandas, já que os grupos de bandas dependem do número de blocos), índices dos pixels, janelas das imagens
+        # sobrepostas e arrays temporários da interpolação
+        # número máximo de imagens sobrepostas (limite superior pelo índice espacial)
+        n_sobrep = max([len(indice.intersects(caixas[img])) for img in caixas]) if sobrep != 0 else 1
+        razao = max([max(resol_X*resol_Y/(imgs[img]['xres']*imgs[img]['yres']), 1) for img in imgs])
+        item = np.dtype(tipo).itemsize
+        temp = {'nearest': 64, 'bilinear': 160, 'bicubic': 400}[reamostragem]
+        pilha = 24 if sobrep != 0 else 0 # pilha de valores, pesos e ordenação (mediana) em float64
+        agregado = 8 if sobrep != 0 else 0 # resultado da agregação em float64
+        bytes_px = n_bands*(item + agregado) + 16 + n_sobrep*(razao*item + temp + pilha + 1)
+        lado = int(np.sqrt(memoria*2**20/n_proc/bytes_px))
+        lado = max(64, 256*(lado//256) if lado >= 256 else lado)
+        lin_bloco = min(lado, n_lin)
+        col_bloco = min(lado, n_col)
+        # Blocos e imagens que contribuem para cada um (consulta ao índice espacial)
+        blocos = []
+        for lin_ini in range(0, n_lin, lin_bloco):
+            for col_ini in range(0, n_col, col_bloco):
+                n_lin_bloco = min(lin_bloco, n_lin - lin_ini)
+                n_col_bloco = min(col_bloco, n_col - col_ini)
+                retangulo = QgsRectangle(origem[0] + col_ini*resol_X,
+                                         origem[1] - (lin_ini + n_lin_bloco)*resol_Y,
+                                         origem[0] + (col_ini + n_col_bloco)*resol_X,
+                                         origem[1] - lin_ini*resol_Y)
+                contribuintes = sorted(indice.intersects(retangulo))
+                blocos += [(lin_ini, col_ini, n_lin_bloco, n_col_bloco, contribuintes)]
+        feedback.pushInfo(self.tr('Processing blocks: {} of {}x{} pixels', 'Blocos de processamento: {} de {}x{} pixels').format(len(blocos), lin_bloco, col_bloco))
+        # Dividir também as bandas quando houver menos blocos que processos
+        n_grupos = min(n_bands, -(-n_proc//len(blocos)))
+        grupos = [list(range(n_bands))[k::n_grupos] for k in range(n_grupos)]
+        tarefas = [(bloco, bandas) for bloco in blocos for bandas in grupos]
+
+        param = {'imgs': imgs,
+                 'caixas': caixas,
+                 'moldura_geom': moldura_geom,
+                 'origem': origem,
+                 'resol_X': resol_X,
+                 'resol_Y': resol_Y,
+                 'sobrep': sobrep,
+                 'reamostragem': reamostragem,
+                 'valor_nulo': valor_nulo,
+                 'tipo': tipo,
+                 'inteiro': inteiro}
+        self.local = threading.local()
 
         # Criar Raster
-        Driver = gdal.GetDriverByName('GTiff').Create(Output, n_col, n_lin, n_bands, GDT)
+        Driver = gdal.GetDriverByName('GTiff').Create(Output, n_col, n_lin, n_bands, GDT, options = self.OpcoesGTiff(GDT, n_bands, compressao, tiled, ladrilho))
         Driver.SetGeoTransform(geotransform)
         Driver.SetProjection(prj)
+        if NULO != -1:
+            for k in range(n_bands):
+                Driver.GetRasterBand(k+1).SetNoDataValue(valor_nulo)
 
-
-        # Mosaicar por banda
-        Percent = 100.0/(n_lin*n_col*n_bands)
+        # Mosaicar por bloco e grupo de bandas em paralelo e escrever os resultados no disco
+        feedback.pushInfo(self.tr('Mosaicking with {} worker(s)...', 'Mosaicando com {} processo(s)...').format(n_proc))
+        Percent = 100.0/len(tarefas)
         current = 0
-        
-        imgs = {}
-        for k in range(n_bands):
-            feedback.pushInfo((self.tr('Creating band {}...', 'Criando banda {}...')).format(str(k+1)))
-            # Criar Array do mosaico
-            tipo = gdal_array.GDALTypeCodeToNumericTypeCode(GDT)
-            inteiro = True if GDT in (gdal.GDT_Byte,
-                                      gdal.GDT_UInt16,
-                                      gdal.GDT_Int16,
-                                      gdal.GDT_UInt32,
-                                      gdal.GDT_Int32) else False
-            banda = np.ones((n_lin,n_col), dtype = tipo) * (int(valor_nulo) if inteiro else valor_nulo)
-            # Para cada classe abrir banda da(s) imagem(ns)
-            for classe in classes:
-                # Deixando somente imagens a serem utilizadas
-                for item in valores:
-                    if (item not in classe) and (item in imgs):
-                        del imgs[item]
-                # Preenchendo dados da imagem no dicionário
-                for img in classe:
-                    if img not in imgs:
-                        img_path = lista[img-1]
-                        image = gdal.Open(img_path)
-                        ulx, xres, xskew, uly, yskew, yres  = image.GetGeoTransform()
-                        img_origem = (ulx, uly)
-                        img_resol_X = abs(xres)
-                        img_resol_Y = abs(yres)
-                        img_band = image.GetRasterBand(k+1).ReadAsArray()
-                        imgs[img] = {'band': img_band,
-                                     'xres': img_resol_X,
-                                     'yres': img_resol_Y,
-                                     'origem': img_origem }
-                        image = None
-                if sobrep == 0: # Se for "primeiro", interpolar apenas da primeira img da comb, caso contrário
-                    img = classe[0]
-                    # Para cada pixel da classe
-                    for px in classes[classe]['pixels']:
-                        lin,col = px
-                        X = origem[0] + resol_X*(col + 0.5)
-                        Y = origem[1] - resol_Y*(lin + 0.5)
-                        Interpolado = self.Interpolar(X, Y, 
-                                                 imgs[img]['band'],
-                                                 imgs[img]['origem'],
-                                                 imgs[img]['xres'],
-                                                 imgs[img]['yres'],
-                                                 reamostragem,
-                                                 valor_nulo)
-                        if Interpolado != valor_nulo:
-                            banda[lin][col] = round(Interpolado) if inteiro else Interpolado
-                        
-                        if feedback.isCanceled():
-                            break
-                        current += 1
-                        feedback.setProgress(int(current * Percent))
-                
-                else: # Para cada pixel da classe interpolar o valor da banda de cada img
-                    for px in classes[classe]['pixels']:
-                        lin,col = px
-                        X = origem[0] + resol_X*(col + 0.5)
-                        Y = origem[1] - resol_Y*(lin + 0.5)
-                        interp_values = []
-                        for img in imgs:
-                            Interpolado = self.Interpolar(X, Y, 
-                                                     imgs[img]['band'],
-                                                     imgs[img]['origem'],
-                                                     imgs[img]['xres'],
-                                                     imgs[img]['yres'],
-                                                     reamostragem,
-                                                     valor_nulo)
-                            if Interpolado != valor_nulo:
-                                interp_values += [Interpolado]
-                        # Calcular o valor agregado (0:first, 1:average, 2:median, 3:min, 4:max) e inserir na banda (se byte, arredondar)
-                        if interp_values:
-                            if sobrep == 1:
-                                result = np.mean(interp_values)
-                            elif sobrep == 2:
-                                result = np.median(interp_values)
-                            elif sobrep == 3:
-                                result = np.min(interp_values)
-                            elif sobrep == 4:
-                                result = np.max(interp_values)
-                            banda[lin][col] = round(result) if inteiro else result
-                        
-                        if feedback.isCanceled():
-                            break
-                        current += 1
-                        feedback.setProgress(int(current * Percent))
-
-            # Salvar banda
-            outband = Driver.GetRasterBand(k+1)
-            feedback.pushInfo(self.tr('Writing Band {}...'.format(k+1), 'Escrevendo Banda {}...'.format(k+1)))
-            outband.WriteArray(banda)
-            if NULO != -1:
-                outband.SetNoDataValue(valor_nulo)
+        with ThreadPoolExecutor(max_workers = n_proc) as executor:
+            pendentes = set()
+            for bloco, bandas in tarefas:
+                pendentes.add(executor.submit(self.MosaicarBloco, bloco, bandas, param))
+                # No máximo n_proc tarefas em memória: escrever as que ficarem prontas
+                if len(pendentes) >= n_proc:
+                    prontas, pendentes = wait(pendentes, return_when = FIRST_COMPLETED)
+                    current += self.EscreverBlocos(Driver, prontas)
+                    feedback.setProgress(int(current * Percent))
+                if feedback.isCanceled():
+                    break
+            if feedback.isCanceled():
+                for tarefa in pendentes:
+                    tarefa.cancel()
+            else:
+                current += self.EscreverBlocos(Driver, wait(pendentes)[0])
+                feedback.setProgress(int(current * Percent))
 
         # Salvar e Fechar Raster
+        if piramides:
+            self.CriarPiramides(Driver)
         Driver.FlushCache()   # Escrever no disco
         Driver = None   # Salvar e fechar
         
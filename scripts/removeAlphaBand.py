@@ -97,6 +97,10 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
     
     RasterIN ='RasterIN'
     RasterOUT = 'RasterOUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -117,6 +121,41 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
             )
         )
         
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -126,6 +165,35 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
             )
         )
     
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
         
         RasterIN = self.parameterAsRasterLayer(
@@ -149,6 +217,32 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
         feedback.pushInfo(self.tr('Reading the input raster...', 'Lendo o raster de entrada...'))
         image = gdal.Open(RasterIN) # https://gdal.org/python/
         prj=image.GetProjection()
@@ -164,7 +258,7 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
             raise QgsProcessingException(self.tr('The input raster must have 4 bands!', 'O raster de entrada deve ter 4 bandas!'))
         else:
             # Criate driver
-            Driver = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, 3, GDT)
+            Driver = gdal.GetDriverByName('GTiff').Create(RGB_Output, cols, rows, 3, GDT, options = self.OpcoesGTiff(GDT, 3, compressao, tiled, ladrilho))
             Driver.SetGeoTransform(geotransform)    # specify coords
             Driver.SetProjection(CRS.ExportToWkt()) # export coords to file
             
@@ -186,6 +280,8 @@ class RemoveAlphaBand(QgsProcessingAlgorithm):
                 outband.SetNoDataValue(Pixel_Nulo)
             
             image=None # Close dataset
+            if piramides:
+                self.CriarPiramides(Driver)
             Driver.FlushCache()                     # write to disk
             Driver = None                           # save, close
             
@@ -49,6 +49,7 @@ import gdal #https://gdal.org/python/
 from osgeo import osr, gdal_array
 from math import floor, ceil
 import numpy as np
+import os
 
 class RescaleTo8bits(QgsProcessingAlgorithm):
 
@@ -95,13 +96,20 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
         return self.tr(txt_en, txt_pt) + footer
             
     def tags(self):
-        return self.tr('8bits,8 bits,rescale,radiometric,reduce,reduction,bits,linear,stretch').split(',')
+        return self.tr('8bits,8 bits,rescale,radiometric,reduce,reduction,bits,linear,stretch,equalization,gamma').split(',')
     
     RasterIN ='RasterIN'
     TYPE = 'TYPE'
     BYBAND = 'BYBAND'
     NULLPIXEL = 'NULLPIXEL'
+    STATS = 'STATS'
+    GAMMA = 'GAMMA'
+    LIMITS = 'LIMITS'
     RasterOUT = 'RasterOUT'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -116,7 +124,10 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
         
         opcoes = [self.tr('Min / Max'),
                   self.tr('Quantile (2% - 98%)', 'Quantil (2% - 98%)'),
-                  self.tr('Mean ± 2*stdDev', 'Média ± 2*desvPad')]
+                  self.tr('Mean ± 2*stdDev', 'Média ± 2*desvPad'),
+                  self.tr('Histogram equalization', 'Equalização do histograma'),
+                  self.tr('Gamma (Quantile 2% - 98%)', 'Gama (Quantil 2% - 98%)'),
+                  self.tr('User limits per band', 'Limites do usuário por banda')]
         
         self.addParameter(
             QgsProcessingParameterEnum(
@@ -127,6 +138,25 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.GAMMA,
+                self.tr('Gamma', 'Gama'),
+                type =1, #Double = 1 and Integer = 0
+                defaultValue = 1.0,
+                minValue = 0.01
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.LIMITS,
+                self.tr('User limits (min,max per band separated by semicolons)', 'Limites do usuário (mín,máx por banda separados por ponto e vírgula)'),
+                defaultValue = '',
+                optional = True
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterBoolean(
                 self.BYBAND,
@@ -143,6 +173,19 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             )
         )
         
+        estatisticas = [self.tr('Exact (streaming histograms)', 'Exatas (histogramas em fluxo)'),
+                        self.tr('Approximate (stored GDAL statistics, fast preview)', 'Aproximadas (estatísticas guardadas pelo GDAL, pré-visualização rápida)'),
+                        self.tr('Sampled from a decimated overview', 'Amostradas de uma visão reduzida (pirâmide)')]
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.STATS,
+                self.tr('Statistics', 'Estatísticas'),
+				options = estatisticas,
+                defaultValue= 0
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterBoolean(
                 self.OPEN,
@@ -151,6 +194,41 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             )
         )
         
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -160,6 +238,187 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             )
         )
     
+    # Faixas de linhas da banda com a máscara dos pixels válidos (fora do valor nulo, da banda alfa e da máscara do GDAL, e finitos)
+    # decimado: uma única leitura reduzida para no máximo 2048 pixels no maior lado (o GDAL usa as pirâmides, se existirem)
+    # mascarado: se falso, a máscara não é lida e os pixels válidos retornam como None
+    def Faixas(self, banda, passo, decimado = False, mascarado = True):
+        cols, rows = banda.XSize, banda.YSize
+        mascara = banda.GetMaskBand() if banda.GetMaskFlags() != gdal.GMF_ALL_VALID else None
+        if decimado:
+            fator = max(int(ceil(max(cols, rows)/2048)), 1)
+            janelas = [(0, rows, int(ceil(cols/fator)), int(ceil(rows/fator)))]
+        else:
+            janelas = [(lin, min(passo, rows - lin), cols, min(passo, rows - lin)) for lin in range(0, rows, passo)]
+        for lin, n_lin, buf_x, buf_y in janelas:
+            bloco = banda.ReadAsArray(0, lin, cols, n_lin, buf_xsize = buf_x, buf_ysize = buf_y)
+            if not mascarado:
+                yield lin, bloco, None
+                continue
+            validos = mascara.ReadAsArray(0, lin, cols, n_lin, buf_xsize = buf_x, buf_ysize = buf_y) > 0 if mascara is not None else np.ones(bloco.shape, dtype=bool)
+            if not np.issubdtype(bloco.dtype, np.integer):
+                validos &= np.isfinite(bloco)
+            yield lin, bloco, validos
+    
+    # Estatísticas da banda em fluxo, somente com os pixels válidos
+    # Tipos inteiros de até 16 bits: histograma exato; demais tipos: mínimo, máximo, média e desvio padrão exatos
+    # e uma amostra regular dos pixels para os quantis. Modo aproximado: estatísticas já guardadas pelo GDAL (sem calculá-las,
+    # para não alterar o .aux.xml da entrada) ou, na falta delas, da leitura reduzida, e histograma da leitura reduzida
+    # Retorna os valores ordenados com suas contagens (histograma), usados nos quantis e na equalização
+    def Estatisticas(self, banda, modo, passo):
+        cols, rows = banda.XSize, banda.YSize
+        if modo == 1:
+            amostra = np.concatenate([bloco[validos].astype(float) for lin, bloco, validos in self.Faixas(banda, passo, True)])
+            if amostra.size == 0:
+                raise QgsProcessingException(self.tr('The band has no valid pixels!', 'A banda não tem pixels válidos!'))
+            try:
+                est = banda.GetStatistics(True, False)
+            except RuntimeError:
+                est = None
+            if est is None or est[3] < 0 or not est[0] <= est[1]:
+                est = [amostra.min(), amostra.max(), amostra.mean(), amostra.std()]
+            Min, Max, media, desvpad = est
+            n_bins = 1024
+            largura = (Max - Min)/n_bins if Max > Min else 1.0/n_bins
+            contagens, _ = np.histogram(np.clip(amostra, Min, Max), bins = n_bins, range = (Min, Min + n_bins*largura))
+            contagens = contagens.astype(float)
+            valores = Min + largura*(np.arange(n_bins) + 0.5)
+            return {'valores': valores, 'contagens': contagens, 'min': Min, 'max': Max, 'media': media, 'desvpad': desvpad}
+        tipo = gdal_array.GDALTypeCodeToNumericTypeCode(banda.DataType)
+        if np.issubdtype(tipo, np.integer) and np.dtype(tipo).itemsize <= 2:
+            info = np.iinfo(tipo)
+            contagens = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+            for lin, bloco, validos in self.Faixas(banda, passo, modo == 2):
+                bloco = bloco[validos]
+                if info.min < 0:
+                    bloco = bloco.astype(np.int32) - int(info.min)
+                contagens += np.bincount(bloco, minlength = len(contagens))
+            valores = np.arange(int(info.min), int(info.max) + 1)
+            presentes = contagens > 0
+            if not presentes.any():
+                raise QgsProcessingException(self.tr('The band has no valid pixels!', 'A banda não tem pixels válidos!'))
+            valores, contagens = valores[presentes], contagens[presentes]
+            n = contagens.sum()
+            media = (contagens*valores).sum()/n
+            desvpad = np.sqrt((contagens*(valores - media)**2).sum()/n)
+            return {'valores': valores, 'contagens': contagens, 'min': valores[0], 'max': valores[-1], 'media': media, 'desvpad': desvpad}
+        # Soma e soma dos quadrados com deslocamento (primeiro valor) para estabilidade numérica
+        salto = max(cols*rows // 2**22, 1) if modo == 0 else 1
+        n, S, SS, K = 0, 0.0, 0.0, None
+        Min, Max = np.inf, -np.inf
+        amostra = []
+        for lin, bloco, validos in self.Faixas(banda, passo, modo == 2):
+            bloco = bloco[validos].astype(float)
+            if bloco.size == 0:
+                continue
+            if K is None:
+                K = bloco[0]
+            n += bloco.size
+            S += (bloco - K).sum()
+            SS += ((bloco - K)**2).sum()
+            Min, Max = min(Min, bloco.min()), max(Max, bloco.max())
+            amostra += [bloco[::salto]]
+        if n == 0:
+            raise QgsProcessingException(self.tr('The band has no valid pixels!', 'A banda não tem pixels válidos!'))
+        valores = np.sort(np.concatenate(amostra))
+        media = K + S/n
+        desvpad = np.sqrt(max(SS - S**2/n, 0)/n)
+        return {'valores': valores, 'contagens': np.ones(len(valores)), 'min': Min, 'max': Max, 'media': media, 'desvpad': desvpad}
+    
+    # Estatísticas já calculadas na sessão (chave: arquivo, data de modificação, banda e modo), reaproveitadas
+    # ao refazer o reescalonamento com outros parâmetros. Somente as últimas MAX_HISTOGRAMAS bandas são guardadas,
+    # pois a amostra dos tipos reais pode ter alguns milhões de valores por banda
+    HISTOGRAMAS = {}
+    MAX_HISTOGRAMAS = 8
+    def EstatisticasCache(self, caminho, image, k, modo, passo):
+        try:
+            data = os.path.getmtime(caminho)
+        except OSError:
+            data = None
+        chave = (caminho, data, k, modo)
+        if chave in self.HISTOGRAMAS:
+            # Reinserir para ficar como o mais recente
+            self.HISTOGRAMAS[chave] = self.HISTOGRAMAS.pop(chave)
+        else:
+            self.HISTOGRAMAS[chave] = self.Estatisticas(image.GetRasterBand(k+1), modo, passo)
+            while len(self.HISTOGRAMAS) > self.MAX_HISTOGRAMAS:
+                del self.HISTOGRAMAS[next(iter(self.HISTOGRAMAS))]
+        return self.HISTOGRAMAS[chave]
+    
+    # Limites do usuário a partir do texto (ex.: '100,3000' para todas as bandas ou '100,3000;120,2800;90,3100')
+    def Limites(self, texto, n_bands):
+        try:
+            limites = [[float(v) for v in par.split(',')] for par in texto.split(';') if par.strip()]
+        except ValueError:
+            limites = []
+        if len(limites) == 1:
+            limites = limites*n_bands
+        if len(limites) != n_bands or any([len(par) != 2 or par[1] <= par[0] for par in limites]):
+            raise QgsProcessingException(self.tr('Enter one pair min,max (min < max) for all bands or for each band!', 'Informe um par mín,máx (mín < máx) para todas as bandas ou para cada banda!'))
+        return limites
+    
+    # Quantil a partir dos valores ordenados e suas contagens (mesma interpolação linear do np.quantile)
+    def Quantil(self, est, q):
+        acum = np.cumsum(est['contagens'])
+        pos = q*(acum[-1] - 1)
+        i = floor(pos)
+        v0 = est['valores'][min(np.searchsorted(acum, i, side='right'), len(acum) - 1)]
+        v1 = est['valores'][min(np.searchsorted(acum, i + 1, side='right'), len(acum) - 1)]
+        return v0 + (pos - i)*(v1 - v0)
+    
+    # Transformação para 8 bits (a mesma função é usada nos blocos e na tabela de conversão)
+    # 0, 1, 2 e 5: linear entre Min e Max; 3: equalização do histograma; 4: linear com correção gama
+    def Reescalonar(self, band, Min, Max, min8, eps, tipo, est = None, gama = 1.0):
+        if tipo == 3:
+            acum = np.cumsum(est['contagens'])
+            nivel = np.interp(band, est['valores'], acum/acum[-1])
+            return (min8 + (255 - min8)*nivel).round().astype('uint8')
+        if tipo == 4:
+            nivel = np.clip((band.astype('float')-Min)/(Max-Min), 0, 1)**(1/gama)
+            return (min8 + (255 - min8)*nivel).round().astype('uint8')
+        transf = ((256-eps-min8)*(band.astype('float')-Min)/(Max-Min)+min8-0.5+eps).round()
+        if tipo in [1,2]:
+            transf = ((transf>0)*(transf<=255))*transf + 255*(transf>255) +1*(transf<1)
+        else: # valores fora de [Min, Max] (estatísticas aproximadas ou limites do usuário)
+            transf = np.clip(transf, min8, 255)
+        return transf.astype('uint8')
+    
+    # Tabela de conversão (LUT) com o valor de 8 bits de cada valor possível dos tipos inteiros de até 16 bits
+    # Retorna None para os demais tipos
+    def TabelaConversao(self, dtype, Min, Max, min8, eps, tipo, est = None, gama = 1.0):
+        if not (np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2):
+            return None
+        info = np.iinfo(dtype)
+        return self.Reescalonar(np.arange(int(info.min), int(info.max) + 1), Min, Max, min8, eps, tipo, est, gama)
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
         
         RasterIN = self.parameterAsRasterLayer(
@@ -183,6 +442,32 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             context
         )
         
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
+        
         tipo = self.parameterAsEnum(
             parameters,
             self.TYPE,
@@ -200,6 +485,24 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
             self.NULLPIXEL,
             context
         )
+        
+        modo = self.parameterAsEnum(
+            parameters,
+            self.STATS,
+            context
+        )
+        
+        gama = self.parameterAsDouble(
+            parameters,
+            self.GAMMA,
+            context
+        )
+        
+        limites = self.parameterAsString(
+            parameters,
+            self.LIMITS,
+            context
+        )
 
         min8 = 1 if nullPixel else 0
         eps = np.finfo(float).eps
@@ -214,50 +517,78 @@ class RescaleTo8bits(QgsProcessingAlgorithm):
         CRS=osr.SpatialReference(wkt=prj)
 
         # Criate driver
-        Driver = gdal.GetDriverByName('GTiff').Create(Output, cols, rows, n_bands, gdal.GDT_Byte)
+        Driver = gdal.GetDriverByName('GTiff').Create(Output, cols, rows, n_bands, gdal.GDT_Byte, options = self.OpcoesGTiff(gdal.GDT_Byte, n_bands, compressao, tiled, ladrilho))
         Driver.SetGeoTransform(geotransform)
         Driver.SetProjection(CRS.ExportToWkt())
 
-        bands = []
-        max,min = [],[]
-        for k in range(n_bands):
-            band = image.GetRasterBand(k+1).ReadAsArray()
-            bands += [band]
+        # Faixas de linhas com até 2**22 pixels
+        passo = max(2**22 // cols, 1)
+
+        # 1ª passagem: estatísticas de cada banda (exceto com os limites do usuário)
+        maximos, minimos, ests = [], [], []
+        if tipo == 5:
+            for Min, Max in self.Limites(limites, n_bands):
+                maximos += [Max]
+                minimos += [Min]
+                ests += [None]
+        for k in range(n_bands if tipo != 5 else 0):
+            feedback.pushInfo(self.tr('Computing statistics of band {}...'.format(k+1), 'Calculando estatísticas da banda {}...'.format(k+1)))
+            est = self.EstatisticasCache(RasterIN, image, k, modo, passo)
+            ests += [est]
             # Rescale
-            # Max e Min
-            if tipo == 0:
-                max += [band.max()]
-                min += [band.min()]
+            # Max e Min (a equalização usa o histograma inteiro)
+            if tipo in [0,3]:
+                maximos += [est['max']]
+                minimos += [est['min']]
             # Quantile (2% - 98%)
-            if tipo == 1:
-                max += [np.quantile(band,0.98)]
-                min += [np.quantile(band,0.02)]
+            if tipo in [1,4]:
+                maximos += [self.Quantil(est, 0.98)]
+                minimos += [self.Quantil(est, 0.02)]
             # Media ± 2*DesvPad
             if tipo == 2:
-                max += [band.mean() + 2*band.std()]
-                min += [band.mean() - 2*band.std()]
+                maximos += [est['media'] + 2*est['desvpad']]
+                minimos += [est['media'] - 2*est['desvpad']]
+            feedback.setProgress(int(50*(k+1)/n_bands))
+            if feedback.isCanceled():
+                break
 
-        if not porBanda:
-            Max = np.max(max)
-            Min = np.min(min)
+        # A equalização e os limites do usuário são sempre por banda
+        if not porBanda and tipo not in [3,5]:
+            Max = np.max(maximos)
+            Min = np.min(minimos)
 
-        # Rescale and save bands
-        for k in range(n_bands):
-            band = bands[k]
-            if porBanda:
-                Max = max[k]
-                Min = min[k]
-            transf = ((256-eps-min8)*(band.astype('float')-Min)/(Max-Min)+min8-0.5+eps).round()
-            if tipo in [1,2]:
-                transf = ((transf>0)*(transf<=255))*transf + 255*(transf>255) +1*(transf<1)
-            transf = transf.astype('uint8')
+        # 2ª passagem: reescalonar e salvar as bandas por faixas de linhas
+        for k in range(len(maximos)):
+            if porBanda or tipo in [3,5]:
+                Max = maximos[k]
+                Min = minimos[k]
+            if Max <= Min: # banda constante
+                Max = Min + 1
+            banda = image.GetRasterBand(k+1)
             outband = Driver.GetRasterBand(k+1)
             feedback.pushInfo(self.tr('Writing Band {}...'.format(k+1), 'Escrevendo Banda {}...'.format(k+1)))
-            outband.WriteArray(transf)
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(banda.DataType)
+            LUT = self.TabelaConversao(dtype, Min, Max, min8, eps, tipo, ests[k], gama)
+            for lin, band, validos in self.Faixas(banda, passo, mascarado = nullPixel):
+                if LUT is None:
+                    transf = self.Reescalonar(band, Min, Max, min8, eps, tipo, ests[k], gama)
+                elif np.iinfo(dtype).min < 0:
+                    transf = np.take(LUT, band.astype(np.int32) - int(np.iinfo(dtype).min))
+                else:
+                    transf = np.take(LUT, band)
+                # Pixels nulos da entrada (valor nulo, alfa ou máscara) como zero na saída
+                if nullPixel:
+                    transf[~validos] = 0
+                outband.WriteArray(transf, 0, lin)
             if nullPixel:
                 outband.SetNoDataValue(0)
+            feedback.setProgress(50 + int(50*(k+1)/n_bands))
+            if feedback.isCanceled():
+                break
 
         image=None # Close dataset
+        if piramides:
+            self.CriarPiramides(Driver)
         Driver.FlushCache()                     # write to disk
         Driver = None                           # save, close
             
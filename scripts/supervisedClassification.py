@@ -29,6 +29,7 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterString,
                        QgsProcessingParameterField,
                        QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
                        QgsProcessingParameterCrs,
                        QgsProcessingParameterEnum,
                        QgsFeatureRequest,
@@ -36,20 +37,23 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterFile,
                        QgsProcessingParameterMultipleLayers,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterRasterDestination,
                        QgsApplication,
                        QgsProject,
                        QgsRasterLayer,
+                       QgsRectangle,
                        QgsCoordinateTransform,
                        QgsCoordinateReferenceSystem)
 
 from math import floor, ceil
 import gdal
-from osgeo import osr, gdal_array
-from matplotlib import path
+from osgeo import osr, gdal_array, ogr
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import threading, os, json
 
 class SupervisedClassification(QgsProcessingAlgorithm):
 
@@ -101,8 +105,20 @@ class SupervisedClassification(QgsProcessingAlgorithm):
     RasterIN ='RasterIN'
     RasterOUT = 'RasterOUT'
     CLASSES = 'CLASSES'
+    MODEL = 'MODEL'
+    MODEL_OUT = 'MODEL_OUT'
+    VALIDATION = 'VALIDATION'
+    MEASURE = 'MEASURE'
+    MEASURES = 'MEASURES'
+    REPORT = 'REPORT'
     METHOD = 'METHOD'
     SIZE = 'SIZE'
+    MEMORY = 'MEMORY'
+    WORKERS = 'WORKERS'
+    COMPRESS = 'COMPRESS'
+    TILED = 'TILED'
+    BLOCKSIZE = 'BLOCKSIZE'
+    OVERVIEWS = 'OVERVIEWS'
     OPEN = 'OPEN'
     
     def initAlgorithm(self, config=None):
@@ -119,14 +135,34 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             QgsProcessingParameterFeatureSource(
                 self.CLASSES,
                 self.tr('Polygon layer'),
-                [QgsProcessing.TypeVectorPolygon]
+                [QgsProcessing.TypeVectorPolygon],
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.MODEL,
+                self.tr('Classifier model (instead of the polygon layer)', 'Modelo do classificador (em vez da camada de polígonos)'),
+                extension = 'json',
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.VALIDATION,
+                self.tr('Validation polygon layer (accuracy report)', 'Camada de polígonos de validação (relatório de acurácia)'),
+                [QgsProcessing.TypeVectorPolygon],
+                optional = True
             )
         )
         
         metodos = [self.tr('Parallelepiped', 'Paralelepípedo'),
                    self.tr('Ellipsoid', 'Elipsoide'),
                    self.tr('Euclidean Distance', 'Distância Euclidiana'),
-                   self.tr('Mahalanobis Distance', 'Distância de Mahalanobis')]
+                   self.tr('Mahalanobis Distance', 'Distância de Mahalanobis'),
+                   self.tr('Maximum Likelihood', 'Máxima Verossimilhança')]
 
         self.addParameter(
             QgsProcessingParameterEnum(
@@ -150,6 +186,74 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MEMORY,
+                self.tr('Memory limit (MB)', 'Limite de memória (MB)'),
+                type =0, #Double = 1 and Integer = 0
+                defaultValue = 512,
+                minValue = 16
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Maximum number of workers (CPU cores)', 'Número máximo de processos (núcleos de CPU)'),
+                type =0, #Double = 1 and Integer = 0
+                defaultValue = os.cpu_count() or 1,
+                minValue = 1
+            )
+        )
+        
+        medidas = [self.tr('Euclidean distance', 'Distância Euclidiana'),
+                   self.tr('Mahalanobis distance', 'Distância de Mahalanobis'),
+                   self.tr('Posterior probability (maximum likelihood)', 'Probabilidade a posteriori (máxima verossimilhança)')]
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MEASURE,
+                self.tr('Measure of the class distances raster', 'Medida do raster de distâncias das classes'),
+				options = medidas,
+                defaultValue= 1
+            )
+        )
+        
+        # Perfil do GeoTIFF de saída
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.COMPRESS,
+                self.tr('Compression', 'Compressão'),
+				options = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.TILED,
+                self.tr('Tiled', 'Ladrilhado (tiled)'),
+                defaultValue= True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BLOCKSIZE,
+                self.tr('Tile size (pixels)', 'Tamanho do ladrilho (pixels)'),
+				options = ['128', '256', '512', '1024'],
+                defaultValue= 1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERVIEWS,
+                self.tr('Build internal overviews', 'Criar pirâmides internas'),
+                defaultValue= False
+            )
+        )
+        
         # OUTPUT
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -159,6 +263,36 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.MODEL_OUT,
+                self.tr('Classifier model', 'Modelo do classificador'),
+                fileFilter = '.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.MEASURES,
+                self.tr('Class distances or probabilities', 'Distâncias ou probabilidades das classes'),
+                fileFilter = '.tif',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.REPORT,
+                self.tr('Accuracy report', 'Relatório de acurácia'),
+                self.tr('HTML files (*.html)'),
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterBoolean(
                 self.OPEN,
@@ -167,6 +301,333 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             )
         )
     
+    # Treinamento: estatísticas das classes a partir dos polígonos de treinamento (campo "tipo" com o código da classe)
+    def Treinar(self, layer, image, metodo, fator, memoria, feedback):
+        n_bands = image.RasterCount
+
+        # Somas e produtos cruzados acumulados por classe (deslocados pelo primeiro pixel para estabilidade numérica)
+        feedback.pushInfo(self.tr('Sampling training polygons...', 'Amostrando polígonos de treinamento...'))
+        codigos = []
+        estat = {}
+        for X, ids in self.PixelsAmostras(layer, image, memoria, codigos, feedback):
+            for ind in np.unique(ids):
+                Xc = X[ids == ind]
+                if ind not in estat:
+                    estat[ind] = {'n': 0, 'K': Xc[0], 'S': np.zeros(n_bands), 'SS': np.zeros((n_bands, n_bands))}
+                D = Xc - estat[ind]['K']
+                estat[ind]['n'] += len(D)
+                estat[ind]['S'] += D.sum(axis = 0)
+                estat[ind]['SS'] += D.T.dot(D)
+
+        # Cálculo da Média por banda e MVC de cada classe
+        dic = {}
+        ordem = []
+        for ind, code in enumerate(codigos):
+            est = estat.get(ind+1, {'n': 0})
+            n = est['n']
+            if n < 2:
+                raise QgsProcessingException(self.tr('Class {} does not have enough samples inside the input raster!', 'A classe {} não possui amostras suficientes dentro do raster de entrada!').format(code))
+            media = est['K'] + est['S']/n
+            MVC = np.matrix((est['SS'] - np.outer(est['S'], est['S'])/n)/(n-1))
+            desvpad = np.sqrt(np.maximum(np.diag(est['SS'])/n - (est['S']/n)**2, 0))
+            dic[code] = {'media': media[:, None],
+                         'desvpad': desvpad[:, None],
+                         'mvc': MVC,
+                         'det': np.linalg.det(MVC*fator**2),
+                         'MVC_inv': np.linalg.inv(MVC)}
+            ordem += [[np.trace(MVC), code]]
+        ordem = sorted(ordem, reverse = True)
+
+        # Estatísticas das classes empilhadas (classes no primeiro eixo) para a classificação vetorizada
+        modelo = {'metodo': metodo,
+                  'fator': fator,
+                  'codigos': np.array(codigos),
+                  'ordem': np.array([codigos.index(code) for traco, code in ordem]),
+                  'media': np.array([dic[code]['media'][:,0] for code in codigos]),
+                  'desvpad': np.array([dic[code]['desvpad'][:,0] for code in codigos]),
+                  'mvc': np.array([np.array(dic[code]['mvc']) for code in codigos]),
+                  'det': np.array([dic[code]['det'] for code in codigos]),
+                  'MVC_inv': np.array([np.array(dic[code]['MVC_inv']) for code in codigos]),
+                  'n': np.array([estat[ind+1]['n'] for ind in range(len(codigos))])}
+        return modelo
+    
+    # Pixels amostrados pelos polígonos (campo "tipo" com o código da classe), lidos bloco a bloco
+    # Gera a matriz de pixels (N x bandas) e o índice (1, 2, ...) da classe de cada pixel na lista codigos,
+    # que recebe os códigos dos polígonos ainda não listados
+    def PixelsAmostras(self, layer, image, memoria, codigos, feedback):
+        n_bands = image.RasterCount
+        cols = image.RasterXSize
+        rows = image.RasterYSize
+        item = gdal.GetDataTypeSize(image.GetRasterBand(1).DataType)//8
+        ulx, xres, xskew, uly, yskew, yres  = image.GetGeoTransform()
+        origem = (ulx, uly)
+        resol_X = abs(xres)
+        resol_Y = abs(yres)
+
+        # Polígonos das amostras e extensão (polígonos fora do raster são avisados e ignorados)
+        imagem_rect = QgsRectangle(origem[0], origem[1] - rows*resol_Y, origem[0] + cols*resol_X, origem[1])
+        amostras = []
+        extensao = None
+        for feat in layer.getFeatures():
+            code = feat['tipo']
+            geom = feat.geometry()
+            if not geom.boundingBox().intersects(imagem_rect):
+                feedback.reportError(self.tr('Polygon {} (class {}) is outside the input raster!', 'Polígono {} (classe {}) está fora do raster de entrada!').format(feat.id(), code))
+                continue
+            if code not in codigos:
+                codigos += [code]
+            amostras += [(codigos.index(code)+1, geom)]
+            if extensao is None:
+                extensao = QgsRectangle(geom.boundingBox())
+            else:
+                extensao.combineExtentWith(geom.boundingBox())
+        if extensao is None:
+            if layer.featureCount() > 0:
+                raise QgsProcessingException(self.tr('The sample polygons do not overlap the input raster!', 'Os polígonos das amostras não sobrepõem o raster de entrada!'))
+            raise QgsProcessingException(self.tr('The polygon layer has no samples!', 'A camada de polígonos não possui amostras!'))
+
+        # Tamanho dos blocos a partir do limite de memória
+        lado = self.LadoBloco(memoria, n_bands, item, len(codigos))
+
+        # Janela da imagem coberta pelas amostras
+        col_min = max(int(np.floor((extensao.xMinimum() - origem[0])/resol_X)), 0)
+        col_max = min(int(np.ceil((extensao.xMaximum() - origem[0])/resol_X)), cols)
+        lin_min = max(int(np.floor((origem[1] - extensao.yMaximum())/resol_Y)), 0)
+        lin_max = min(int(np.ceil((origem[1] - extensao.yMinimum())/resol_Y)), rows)
+        if col_min >= col_max or lin_min >= lin_max:
+            raise QgsProcessingException(self.tr('The sample polygons do not overlap the input raster!', 'Os polígonos das amostras não sobrepõem o raster de entrada!'))
+
+        # Índice da classe de cada pixel amostrado, rasterizado bloco a bloco (camada OGR criada uma única vez)
+        fonte = self.CamadaAmostras(amostras)
+        for lin in range(lin_min, lin_max, lado):
+            for col in range(col_min, col_max, lado):
+                n_lin, n_col = min(lado, lin_max-lin), min(lado, col_max-col)
+                ids_bloco = self.RasterizarAmostras(fonte, (origem[0] + col*resol_X, origem[1] - lin*resol_Y), resol_X, resol_Y, n_lin, n_col).ravel()
+                amostrado = ids_bloco > 0
+                if not amostrado.any():
+                    continue
+                X = np.stack([image.GetRasterBand(k+1).ReadAsArray(col, lin, n_col, n_lin).ravel()[amostrado] for k in range(n_bands)], axis = 1).astype('float')
+                yield X, ids_bloco[amostrado]
+    
+    # Matriz de confusão das amostras de validação (linhas: referência, colunas: classificação)
+    def Validar(self, layer, image, modelo, memoria, feedback):
+        rotulos = list(modelo['codigos'])
+        confusao = {}
+        for X, ids in self.PixelsAmostras(layer, image, memoria, rotulos, feedback):
+            referencia = np.array(rotulos)[ids-1]
+            classificado = self.Classificar(X, modelo)
+            pares, contagem = np.unique(np.stack([referencia, classificado]), axis = 1, return_counts = True)
+            for (ref, clas), n in zip(pares.T, contagem):
+                confusao[(ref, clas)] = confusao.get((ref, clas), 0) + n
+        # Pixels não classificados (código 0) em uma coluna própria
+        if 0 not in rotulos and any(clas == 0 for ref, clas in confusao):
+            rotulos += [0]
+        matriz = np.zeros((len(rotulos), len(rotulos)), dtype = int)
+        for (ref, clas), n in confusao.items():
+            matriz[rotulos.index(ref), rotulos.index(clas)] = n
+        return rotulos, matriz
+    
+    # Relatório de acurácia em HTML: matriz de confusão, exatidão global, acurácias do produtor e do usuário e índice Kappa
+    def RelatorioAcuracia(self, rotulos, matriz):
+        N = matriz.sum()
+        global_ = np.trace(matriz)/N
+        pe = (matriz.sum(axis = 1)*matriz.sum(axis = 0)).sum()/N**2
+        kappa = (global_ - pe)/(1 - pe) if pe < 1 else 1.0
+        produtor = np.diag(matriz)/np.maximum(matriz.sum(axis = 1), 1)
+        usuario = np.diag(matriz)/np.maximum(matriz.sum(axis = 0), 1)
+        celula = '<td style="text-align: center; padding: 2px 8px;">{}</td>'
+        cabecalho = celula.format('') + ''.join([celula.format('<b>{}</b>'.format(r)) for r in rotulos]) + celula.format('<b>' + self.tr("Producer's accuracy", 'Acurácia do produtor') + '</b>')
+        linhas = ''
+        for i, r in enumerate(rotulos):
+            linhas += '<tr>' + celula.format('<b>{}</b>'.format(r)) + ''.join([celula.format(n) for n in matriz[i]]) + celula.format('{:.2%}'.format(produtor[i])) + '</tr>\n'
+        linhas += '<tr>' + celula.format('<b>' + self.tr("User's accuracy", 'Acurácia do usuário') + '</b>') + ''.join([celula.format('{:.2%}'.format(u)) for u in usuario]) + celula.format('') + '</tr>\n'
+        texto = '''<html>
+<head>
+  <meta content="text/html; charset=utf-8" http-equiv="content-type">
+  <title>[titulo]</title>
+</head>
+<body>
+<p style="text-align: center;"><b><u>[titulo]</u></b></p>
+<p style="text-align: center;">[legenda]</p>
+<div align="center">
+<table border="1" style="border-collapse: collapse;">
+<tr>[cabecalho]</tr>
+[linhas]</table>
+</div>
+<p style="text-align: center;">[global]: <b>[valor_global]</b><br>Kappa: <b>[kappa]</b><br>[amostras]: [N]</p>
+</body>
+</html>
+'''
+        itens = {'[titulo]': self.tr('ACCURACY REPORT', 'RELATÓRIO DE ACURÁCIA'),
+                 '[legenda]': self.tr('Rows: validation classes / Columns: classified classes', 'Linhas: classes de validação / Colunas: classes classificadas'),
+                 '[cabecalho]': cabecalho,
+                 '[linhas]': linhas,
+                 '[global]': self.tr('Overall accuracy', 'Exatidão global'),
+                 '[valor_global]': '{:.2%}'.format(global_),
+                 '[kappa]': '{:.4f}'.format(kappa),
+                 '[amostras]': self.tr('Validation pixels', 'Pixels de validação'),
+                 '[N]': str(N)}
+        for item in itens:
+            texto = texto.replace(item, itens[item])
+        return texto, global_, kappa
+    
+    # Tamanho (lado) dos blocos quadrados a partir do limite de memória (MB)
+    # bytes por pixel: janelas das bandas, matriz de pixels e temporários (float) e distâncias/máscaras por classe
+    def LadoBloco(self, memoria, n_bands, item, n_classes):
+        bytes_px = n_bands*(item + 24) + 16*n_classes + 1
+        lado = int(np.sqrt(memoria*2**20/bytes_px))
+        return max(64, 256*(lado//256) if lado >= 256 else lado)
+    
+    # Salvar o modelo do classificador (estatísticas das classes, método e fator de tamanho) em arquivo JSON
+    def SalvarModelo(self, caminho, modelo):
+        dados = {}
+        for chave in modelo:
+            if chave != 'L_inv':
+                dados[chave] = modelo[chave].tolist() if isinstance(modelo[chave], np.ndarray) else modelo[chave]
+        with open(caminho, 'w') as arq:
+            json.dump(dados, arq, indent = 1)
+    
+    # Ler o modelo do classificador salvo em arquivo JSON
+    def LerModelo(self, caminho):
+        try:
+            with open(caminho) as arq:
+                dados = json.load(arq)
+            modelo = {'metodo': int(dados['metodo']), 'fator': int(dados['fator'])}
+            for chave in ('codigos', 'ordem', 'media', 'desvpad', 'mvc', 'det', 'MVC_inv', 'n'):
+                modelo[chave] = np.array(dados[chave])
+        except (OSError, ValueError, KeyError):
+            raise QgsProcessingException(self.tr('Invalid classifier model file!', 'Arquivo de modelo do classificador inválido!'))
+        return modelo
+    
+    # Camada OGR em memória com os polígonos de treinamento e o índice da classe de cada um
+    def CamadaAmostras(self, amostras):
+        fonte = ogr.GetDriverByName('Memory').CreateDataSource('')
+        camada = fonte.CreateLayer('amostras', geom_type = ogr.wkbMultiPolygon)
+        camada.CreateField(ogr.FieldDefn('classe', ogr.OFTInteger))
+        for ind, geom in amostras:
+            feat = ogr.Feature(camada.GetLayerDefn())
+            feat.SetField('classe', ind)
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+            camada.CreateFeature(feat)
+        return fonte
+    
+    # Grade (bloco) com o índice da classe dos pixels cujos centros estão dentro dos polígonos de treinamento (0 fora deles)
+    # Rasterização em memória: considera todas as partes e os buracos dos polígonos
+    def RasterizarAmostras(self, fonte, origem, resol_X, resol_Y, n_lin, n_col):
+        grade = gdal.GetDriverByName('MEM').Create('', n_col, n_lin, 1, gdal.GDT_UInt16)
+        grade.SetGeoTransform([origem[0], resol_X, 0, origem[1], 0, -resol_Y])
+        camada = fonte.GetLayer(0)
+        camada.SetSpatialFilterRect(origem[0], origem[1] - n_lin*resol_Y, origem[0] + n_col*resol_X, origem[1])
+        gdal.RasterizeLayer(grade, [1], camada, options = ['ATTRIBUTE=classe'])
+        camada.SetSpatialFilter(None)
+        ids = grade.GetRasterBand(1).ReadAsArray()
+        grade = None
+        return ids
+    
+    # Medida de cada classe para os pixels X (classes x pixels)
+    # 'euclidiana' e 'mahalanobis': distâncias ao quadrado; 'verossimilhanca': log da verossimilhança gaussiana com a probabilidade a priori
+    def Medida(self, X, modelo, tipo):
+        M = modelo['media']
+        if tipo == 'euclidiana': # |x|² - 2x.m + |m|²
+            return (X**2).sum(axis = 1) - 2*M.dot(X.T) + (M**2).sum(axis = 1)[:, None]
+        # Mahalanobis com o fator de Cholesky inverso: (x-m)'.MVC_inv.(x-m) = |L_inv.(x-m)|²
+        mah = np.array([((X - M[ind]).dot(L_inv.T)**2).sum(axis = 1) for ind, L_inv in enumerate(modelo['L_inv'])])
+        if tipo == 'mahalanobis':
+            return mah
+        return modelo['log_priori'][:, None] - 0.5*(mah + modelo['logdet'][:, None])
+    
+    # Classificação vetorizada de um conjunto de pixels X (N pixels x bandas)
+    # As medidas calculadas para a classificação ficam guardadas no dicionário medidas
+    def Classificar(self, X, modelo, medidas = None):
+        metodo = modelo['metodo']
+        fator = modelo['fator']
+        M = modelo['media']
+        if metodo in (0, 1):
+            # Pixels dentro do paralelepípedo ou elipsoide de cada classe, na ordem decrescente do traço da MVC
+            dentro = []
+            for ind in modelo['ordem']:
+                m = M[ind]
+                if metodo == 0: # Paralelepípedo
+                    s = modelo['desvpad'][ind]
+                    dentro += [np.all((m-fator*s < X) & (X < m+fator*s), axis = 1)]
+                else: # Elipsoide
+                    D = X - m
+                    dentro += [np.einsum('ij,jk,ik->i', D, modelo['mvc'][ind], D) - modelo['det'][ind] <= 0]
+            dentro = np.array(dentro)
+            # Vence a última classe da ordem que contém o pixel
+            ultima = len(dentro) - 1 - np.argmax(dentro[::-1], axis = 0)
+            return np.where(dentro.any(axis = 0), modelo['codigos'][modelo['ordem']][ultima], 0)
+        # Menor distância Euclidiana ou de Mahalanobis, ou maior verossimilhança
+        tipo = {2: 'euclidiana', 3: 'mahalanobis', 4: 'verossimilhanca'}[metodo]
+        dist = self.Medida(X, modelo, tipo)
+        if medidas is not None:
+            medidas[tipo] = dist
+        if metodo == 4:
+            return modelo['codigos'][np.argmax(dist, axis = 0)]
+        return modelo['codigos'][np.argmin(dist, axis = 0)]
+    
+    # Conexão GDAL com a imagem de entrada, própria de cada processo de trabalho (thread)
+    def ImagemThread(self, caminho):
+        if not hasattr(self.local, 'image'):
+            self.local.image = gdal.Open(caminho)
+        return self.local.image
+    
+    # Ler as bandas de um bloco (coluna, linha, n_col, n_lin) e classificá-lo
+    # Opcionalmente, calcula na mesma passagem a distância (ou probabilidade a posteriori) de cada classe
+    def ClassificarBloco(self, caminho, bloco, modelo, medida = None):
+        image = self.ImagemThread(caminho)
+        col, lin, n_col, n_lin = bloco
+        X = np.stack([image.GetRasterBand(k+1).ReadAsArray(col, lin, n_col, n_lin).ravel() for k in range(image.RasterCount)], axis = 1).astype('float')
+        medidas = {}
+        classes = self.Classificar(X, modelo, medidas).reshape(n_lin, n_col).astype(np.byte)
+        if medida is None:
+            return classes, None
+        valores = medidas[medida] if medida in medidas else self.Medida(X, modelo, medida)
+        X = None
+        if medida == 'verossimilhanca': # Probabilidade a posteriori (normalizada entre as classes)
+            valores = np.exp(valores - valores.max(axis = 0))
+            valores /= valores.sum(axis = 0)
+        else:
+            valores = np.sqrt(np.maximum(valores, 0))
+        return classes, valores.reshape(-1, n_lin, n_col).astype('float32')
+    
+    # Escrever no disco a classificação (e as medidas das classes) de um bloco
+    def EscreverBloco(self, bloco, resultado, banda, medidas_img):
+        classes, valores = resultado
+        banda.WriteArray(classes, bloco[0], bloco[1])
+        if medidas_img is not None:
+            for k in range(len(valores)):
+                medidas_img.GetRasterBand(k+1).WriteArray(valores[k], bloco[0], bloco[1])
+    
+    # OpcoesGTiff e CriarPiramides: cópia idêntica das funções de bands2RGB.py (cópia de referência),
+    # repetida porque cada script é instalado separadamente. Não alterar só aqui: corrigir em bands2RGB.py e replicar
+    # Opções de criação do GeoTIFF de saída (compressão, ladrilhos e BigTIFF)
+    def OpcoesGTiff(self, GDT, n_bands, compressao, tiled, ladrilho):
+        options = ['BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        if tiled:
+            options += ['TILED=YES', 'BLOCKXSIZE=' + ladrilho, 'BLOCKYSIZE=' + ladrilho]
+        # JPEG só para 8 bits, nos demais tipos usar DEFLATE
+        if compressao == 'JPEG' and GDT != gdal.GDT_Byte:
+            compressao = 'DEFLATE'
+        if compressao == 'JPEG':
+            options += ['COMPRESS=JPEG', 'JPEG_QUALITY=75']
+            if n_bands == 3:
+                options += ['PHOTOMETRIC=YCBCR']
+        elif compressao != 'NONE':
+            preditor = '3' if GDT in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+            options += ['COMPRESS=' + compressao, 'PREDICTOR=' + preditor]
+        return options
+    
+    # Pirâmides internas (overviews) em fatores de 2, enquanto o maior lado tiver pelo menos 256 pixels
+    def CriarPiramides(self, Driver, metodo = 'AVERAGE'):
+        niveis = []
+        fator = 2
+        while max(Driver.RasterXSize, Driver.RasterYSize)/fator >= 256:
+            niveis += [fator]
+            fator *= 2
+        if niveis:
+            Driver.BuildOverviews(metodo, niveis)
+    
     def processAlgorithm(self, parameters, context, feedback):
         
         RasterIN = self.parameterAsRasterLayer(
@@ -183,9 +644,12 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             self.CLASSES,
             context
         )
-        if layer is None:
-            raise QgsProcessingException(self.invalidSourceError(parameters, self.CLASSES))
-            
+        
+        arquivo_modelo = self.parameterAsFile(
+            parameters,
+            self.MODEL,
+            context
+        )
         
         metodo = self.parameterAsEnum(
             parameters,
@@ -200,11 +664,49 @@ class SupervisedClassification(QgsProcessingAlgorithm):
         )
         fator = size+1
         
+        memoria = self.parameterAsInt( 
+            parameters,
+            self.MEMORY,
+            context
+        )
+        
+        n_proc = self.parameterAsInt( 
+            parameters,
+            self.WORKERS,
+            context
+        )
+        
         Carregar = self.parameterAsBool( 
             parameters,
             self.OPEN,
             context
         )
+        
+        compressao = self.parameterAsEnum(
+            parameters,
+            self.COMPRESS,
+            context
+        )
+        compressao = ['NONE', 'DEFLATE', 'LZW', 'ZSTD', 'JPEG'][compressao]
+        
+        tiled = self.parameterAsBool(
+            parameters,
+            self.TILED,
+            context
+        )
+        
+        ladrilho = self.parameterAsEnum(
+            parameters,
+            self.BLOCKSIZE,
+            context
+        )
+        ladrilho = ['128', '256', '512', '1024'][ladrilho]
+        
+        piramides = self.parameterAsBool(
+            parameters,
+            self.OVERVIEWS,
+            context
+        )
          
         Raster_Output = self.parameterAsFileOutput( 
             parameters,
@@ -212,199 +714,158 @@ class SupervisedClassification(QgsProcessingAlgorithm):
             context
         )
         
-        # Abrir Raster layer como array
+        modelo_saida = self.parameterAsFileOutput( 
+            parameters,
+            self.MODEL_OUT,
+            context
+        )
+        
+        validacao = self.parameterAsSource(
+            parameters,
+            self.VALIDATION,
+            context
+        )
+        
+        medida = self.parameterAsEnum(
+            parameters,
+            self.MEASURE,
+            context
+        )
+        medida = ['euclidiana', 'mahalanobis', 'verossimilhanca'][medida]
+        
+        medidas_saida = self.parameterAsFileOutput( 
+            parameters,
+            self.MEASURES,
+            context
+        )
+        
+        relatorio = self.parameterAsFileOutput( 
+            parameters,
+            self.REPORT,
+            context
+        )
+        if relatorio and validacao is None:
+            raise QgsProcessingException(self.tr('The accuracy report requires a validation polygon layer!', 'O relatório de acurácia requer uma camada de polígonos de validação!'))
+        
+        # Abrir Raster (as bandas são lidas por janelas)
         image = gdal.Open(RasterIN)
         prj=image.GetProjection()
         geotransform = image.GetGeoTransform()
-        num_bands = image.RasterCount
-        bandas = []
-        for k in range(num_bands):
-            bandas += [image.GetRasterBand(k+1).ReadAsArray()]
         Pixel_Nulo = image.GetRasterBand(1).GetNoDataValue()
         if Pixel_Nulo == None:
             Pixel_Nulo = 0
         n_bands = image.RasterCount # Número de bandas
         cols = image.RasterXSize # Number of columns
         rows = image.RasterYSize # Number of rows
-        # Origem e resolucao da imagem
-        ulx, xres, xskew, uly, yskew, yres  = image.GetGeoTransform()
-        origem = (ulx, uly)
-        resol_X = abs(xres)
-        resol_Y = abs(yres)
-        lrx = ulx + (cols * xres)
-        lry = uly + (rows * yres)
-        bbox = [ulx, lrx, lry, uly]
-        image=None # Fechar imagem
-
-        # Amostra de Raster por poligono
-        dic = {}
-        for feat in layer.getFeatures():
-            code = feat['tipo']
-            if code not in dic:
-                bands_dic = {}
-                for k in range(n_bands):
-                    bands_dic[k+1] = []
-                dic[code] = {'valores': bands_dic}
-            poly = feat.geometry().asPolygon()[0]
-            caminho = []
-            lin_min = 1e8
-            col_min = 1e8
-            lin_max = -1e8
-            col_max = -1e8
-            for ponto in poly:
-                linha = (origem[1]-ponto.y())/resol_Y
-                if linha > lin_max:
-                    lin_max = linha
-                if linha < lin_min:
-                    lin_min = linha
-                coluna = (ponto.x() - origem[0])/resol_X
-                if coluna > col_max:
-                    col_max = coluna
-                if coluna < col_min:
-                    col_min = coluna
-                caminho += [(linha, coluna)]
-            p = path.Path(caminho)
-            lin_min = int(np.floor(lin_min))
-            lin_max = int(np.floor(lin_max))
-            col_min = int(np.floor(col_min))
-            col_max = int(np.floor(col_max))
-            nx, ny = (lin_max-lin_min+1, col_max-col_min+1)
-            lin = np.linspace(lin_min, lin_max, nx)
-            col = np.linspace(col_min, col_max, ny)
-            COL, LIN = np.meshgrid(col, lin)
-            recorte = np.zeros((int(nx), int(ny)), dtype=bool)
-            for x in range(int(nx)):
-                for y in range(int(ny)):
-                    pixel = (LIN[x][y]+0.5, COL[x][y]+0.5) # 0.5 eh o centro do pixel
-                    contem = p.contains_points([pixel])
-                    recorte[x][y] = contem[0]
-            # Recorte de cada banda
-            for k in range(n_bands):
-                banda = bandas[k]
-                recorte_img = banda[lin_min:lin_max+1, col_min:col_max+1]
-                if np.shape(recorte)!=np.shape(recorte_img):
-                    # chegou no fim do recorte
-                    recorte = recorte[0:np.shape(recorte_img)[0], 0:np.shape(recorte_img)[1]]
-                tam = np.shape(recorte_img)
-                valores = []
-                for x in range(tam[0]):
-                    for y in range(tam[1]):
-                        if recorte[x][y]:
-                            valores += [float(recorte_img[x][y])]
-                dic[code]['valores'][k+1] = dic[code]['valores'][k+1] + valores
-
-        # Cálculo da Média por banda e MVC de cada classe
-        ordem = []
-        for code in dic:
-            media = []
-            desvpad = []
-            val_list = []
-            for k in range(n_bands):
-                valores = dic[code]['valores'][k+1]
-                media += [[np.mean(valores)]]
-                desvpad += [[np.std(valores)]]
-                val_list += [valores]
-            MVC = np.matrix(np.cov(np.array(val_list)))
-            media = np.array(media)
-            desvpad = np.array(desvpad)
-            dic[code]['media'] = media
-            dic[code]['desvpad'] = desvpad
-            dic[code]['mvc'] = MVC
-            dic[code]['det'] = np.linalg.det(MVC*fator**2)
-            dic[code]['MVC_inv'] = np.linalg.inv(MVC)
-            ordem += [[np.trace(MVC), code]]
-        ordem = sorted(ordem, reverse = True)
-
-        # Varrer imagem e classificar cada pixel
-        img_class = np.zeros((rows, cols), dtype=np.byte)
-        total = 100.0/rows
-
-        if metodo == 0: # Paralelepípedo
-            for lin in range(rows):
-                for col in range(cols):
-                    px = []
-                    for k in range(n_bands):
-                        px += [[float(bandas[k][lin][col])]]
-                    px = np.array(px)
-                    classe = None
-                    for item in ordem:
-                        m = dic[item[1]]['media']
-                        s = dic[item[1]]['desvpad']
-                        cond = (m-fator*s < px) * (px < m+fator*s)
-                        if cond.sum() == len(px):
-                            classe = item[1]
-                    if classe:
-                        img_class[lin,col] = classe
-                feedback.setProgress(int((lin+1) * total))
+        item = gdal.GetDataTypeSize(image.GetRasterBand(1).DataType)//8
 
-        elif metodo == 1: # Elipsoide
-            for lin in range(rows):
-                for col in range(cols):
-                    px = []
-                    for k in range(n_bands):
-                        px += [[float(bandas[k][lin][col])]]
-                    px = np.array(px)
-                    classe = None
-                    for item in ordem:
-                        m = dic[item[1]]['media']
-                        mvc = dic[item[1]]['mvc']
-                        det = dic[item[1]]['det']
-                        pos = (px - m).T*mvc*(px - m) - det
-                        if pos <= 0:
-                            classe = item[1]
-                    if classe:
-                        img_class[lin,col] = classe
-                feedback.setProgress(int((lin+1) * total))
+        # Modelo do classificador: lido do arquivo ou treinado com os polígonos
+        if arquivo_modelo:
+            if layer is not None:
+                raise QgsProcessingException(self.tr('Choose either the training polygons or the classifier model file, not both!', 'Escolha os polígonos de treinamento ou o arquivo de modelo do classificador, não ambos!'))
+            modelo = self.LerModelo(arquivo_modelo)
+            if modelo['media'].shape[1] != n_bands:
+                raise QgsProcessingException(self.tr('The classifier model and the input raster must have the same number of bands!', 'O modelo do classificador e o raster de entrada devem ter o mesmo número de bandas!'))
+            metodos = [self.tr('Parallelepiped', 'Paralelepípedo'),
+                       self.tr('Ellipsoid', 'Elipsoide'),
+                       self.tr('Euclidean Distance', 'Distância Euclidiana'),
+                       self.tr('Mahalanobis Distance', 'Distância de Mahalanobis'),
+                       self.tr('Maximum Likelihood', 'Máxima Verossimilhança')]
+            if modelo['metodo'] != metodo:
+                feedback.reportError(self.tr('The chosen method is replaced by the method of the classifier model file.', 'O método escolhido é substituído pelo método do arquivo de modelo do classificador.'))
+            metodo = modelo['metodo']
+            fator = modelo['fator']
+            feedback.pushInfo(self.tr('Classifier model with {} classes loaded (method: {}).', 'Modelo do classificador com {} classes carregado (método: {}).').format(len(modelo['codigos']), metodos[metodo]))
+        else:
+            if layer is None:
+                raise QgsProcessingException(self.invalidSourceError(parameters, self.CLASSES))
+            modelo = self.Treinar(layer, image, metodo, fator, memoria, feedback)
+        codigos = list(modelo['codigos'])
+        if modelo_saida:
+            self.SalvarModelo(modelo_saida, modelo)
 
-        elif metodo == 2: # Distância Euclidiana
-            for lin in range(rows):
-                for col in range(cols):
-                    px = []
-                    for k in range(n_bands):
-                        px += [[float(bandas[k][lin][col])]]
-                    px = np.array(px)
-                    min_dist = 1e9
-                    classe = None
-                    for code in dic:
-                        m = dic[code]['media']
-                        MVC_inv = dic[code]['MVC_inv']
-                        dist = (px - m).T*(px - m)
-                        if dist[0][0] < min_dist:
-                            min_dist = dist[0][0]
-                            classe = code
-                    img_class[lin,col] = classe
-                feedback.setProgress(int((lin+1) * total))
+        # Fator de Cholesky inverso, log-determinantes e probabilidades a priori das classes
+        if metodo in (3, 4) or (medidas_saida and medida != 'euclidiana'):
+            L_inv = []
+            for code, mvc in zip(codigos, modelo['mvc']):
+                try:
+                    L_inv += [np.linalg.inv(np.linalg.cholesky(mvc))]
+                except np.linalg.LinAlgError:
+                    raise QgsProcessingException(self.tr('The covariance matrix of class {} is not positive definite!', 'A matriz variância-covariância da classe {} não é positiva definida!').format(code))
+            modelo['L_inv'] = np.array(L_inv)
+            modelo['logdet'] = -2*np.log(np.diagonal(modelo['L_inv'], axis1 = 1, axis2 = 2)).sum(axis = 1)
+            modelo['log_priori'] = np.log(modelo['n']/modelo['n'].sum())
 
-        elif metodo == 3: # Distância de Mahalanobis
-            for lin in range(rows):
-                for col in range(cols):
-                    px = []
-                    for k in range(n_bands):
-                        px += [[float(bandas[k][lin][col])]]
-                    px = np.array(px)
-                    min_dist = 1e9
-                    classe = None
-                    for code in dic:
-                        m = dic[code]['media']
-                        MVC_inv = dic[code]['MVC_inv']
-                        dist_Mah = (px - m).T*MVC_inv*(px - m)
-                        if dist_Mah[0][0] < min_dist:
-                            min_dist = dist_Mah[0][0]
-                            classe = code
-                    img_class[lin,col] = classe
-                feedback.setProgress(int((lin+1) * total))
+        # Matriz de confusão e relatório de acurácia com os polígonos de validação
+        if validacao is not None:
+            feedback.pushInfo(self.tr('Validating with the validation polygons...', 'Validando com os polígonos de validação...'))
+            rotulos, matriz = self.Validar(validacao, image, modelo, memoria, feedback)
+            texto, global_, kappa = self.RelatorioAcuracia(rotulos, matriz)
+            feedback.pushInfo(self.tr('Overall accuracy: {:.2%} / Kappa: {:.4f}', 'Exatidão global: {:.2%} / Kappa: {:.4f}').format(global_, kappa))
+            if relatorio:
+                with open(relatorio, 'w', encoding = 'utf-8') as arq:
+                    arq.write(texto)
 
+        # Blocos da imagem (limite de memória dividido entre os processos)
+        lado = self.LadoBloco(memoria/n_proc, n_bands, item, len(codigos))
+        blocos = [(col, lin, min(lado, cols-col), min(lado, rows-lin)) for lin in range(0, rows, lado) for col in range(0, cols, lado)]
 
-        # Salvando Resultado
-        GDT = gdal_array.NumericTypeCodeToGDALTypeCode(img_class.dtype)
-        classified_img = gdal.GetDriverByName('GTiff').Create(Raster_Output, cols, rows, 1, GDT)
+        # Raster de saída
+        GDT = gdal_array.NumericTypeCodeToGDALTypeCode(np.byte)
+        classified_img = gdal.GetDriverByName('GTiff').Create(Raster_Output, cols, rows, 1, GDT, options = self.OpcoesGTiff(GDT, 1, compressao, tiled, ladrilho))
         classified_img.SetGeoTransform(geotransform)
         classified_img.SetProjection(prj)
         banda = classified_img.GetRasterBand(1)
-        banda.WriteArray(img_class)
         banda.SetNoDataValue(Pixel_Nulo)
+        # Distâncias ou probabilidades a posteriori das classes (uma banda por classe)
+        medidas_img = None
+        if medidas_saida:
+            medidas_img = gdal.GetDriverByName('GTiff').Create(medidas_saida, cols, rows, len(codigos), gdal.GDT_Float32, options = self.OpcoesGTiff(gdal.GDT_Float32, len(codigos), compressao, tiled, ladrilho))
+            medidas_img.SetGeoTransform(geotransform)
+            medidas_img.SetProjection(prj)
+            for k, code in enumerate(codigos):
+                medidas_img.GetRasterBand(k+1).SetDescription(str(code))
+        else:
+            medida = None
+
+        # Classificar os blocos em paralelo e escrever os resultados no disco, na ordem dos blocos
+        # As estatísticas das classes (modelo) são compartilhadas pelos processos de trabalho
+        image=None # Fechar imagem (cada processo abre a sua própria conexão GDAL)
+        self.local = threading.local()
+        feedback.pushInfo(self.tr('Classifying {} blocks with {} worker(s)...', 'Classificando {} blocos com {} processo(s)...').format(len(blocos), n_proc))
+        total = 100.0/len(blocos)
+        escritos = 0
+        with ThreadPoolExecutor(max_workers = n_proc) as executor:
+            pendentes = []
+            for bloco in blocos:
+                pendentes += [(bloco, executor.submit(self.ClassificarBloco, RasterIN, bloco, modelo, medida))]
+                # No máximo n_proc blocos em memória: escrever o mais antigo
+                if len(pendentes) >= n_proc:
+                    pronto, tarefa = pendentes.pop(0)
+                    self.EscreverBloco(pronto, tarefa.result(), banda, medidas_img)
+                    escritos += 1
+                    feedback.setProgress(int(escritos * total))
+                if feedback.isCanceled():
+                    break
+            if feedback.isCanceled():
+                for pronto, tarefa in pendentes:
+                    tarefa.cancel()
+            else:
+                for pronto, tarefa in pendentes:
+                    self.EscreverBloco(pronto, tarefa.result(), banda, medidas_img)
+                    escritos += 1
+                    feedback.setProgress(int(escritos * total))
+
+        # Salvando Resultado
+        if piramides:
+            self.CriarPiramides(classified_img, 'NEAREST')
         classified_img.FlushCache()   # Escrever no disco
         classified_img = None   # Salvar e fechar
+        if medidas_img is not None:
+            if piramides:
+                self.CriarPiramides(medidas_img)
+            medidas_img.FlushCache()
+            medidas_img = None
         
         
         
@@ -412,7 +873,14 @@ class SupervisedClassification(QgsProcessingAlgorithm):
         feedback.pushInfo('Leandro França - Eng Cart')
         self.CAMINHO = Raster_Output
         self.CARREGAR = Carregar
-        return {self.RasterOUT: Raster_Output}
+        saidas = {self.RasterOUT: Raster_Output}
+        if modelo_saida:
+            saidas[self.MODEL_OUT] = modelo_saida
+        if medidas_saida:
+            saidas[self.MEASURES] = medidas_saida
+        if relatorio:
+            saidas[self.REPORT] = relatorio
+        return saidas
     
     # Carregamento de arquivo de saída
     CAMINHO = ''